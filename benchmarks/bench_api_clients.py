@@ -0,0 +1,126 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the per-call overhead of the API clients against a local stub.
+
+Compares constructing a new `OpenAI` client for every request (the previous
+behaviour of `apis.generate_openai`) with the shared client registry. The stub
+server answers immediately, so the measured time is client overhead plus
+connection setup.
+
+    python3 -m benchmarks.bench_api_clients --calls=200 --threads=8
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import http.server
+import json
+import os
+import threading
+import time
+
+from absl import app as absl_app
+from absl import flags
+from openai import OpenAI
+
+from werewolf import apis
+
+_CALLS = flags.DEFINE_integer("calls", 200, "Number of requests per mode.")
+_THREADS = flags.DEFINE_integer("threads", 8, "Number of concurrent callers.")
+
+_RESPONSE = json.dumps(
+    {
+        "id": "stub",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "stub",
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": '{"bid": "1"}'},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": 1,
+            "completion_tokens": 1,
+            "total_tokens": 2,
+        },
+    }
+).encode()
+
+
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = set()
+
+    def do_POST(self):
+        _StubHandler.connections.add(self.client_address)
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(_RESPONSE)
+
+    def log_message(self, *args):
+        pass
+
+
+def _generate_per_call_client(model: str, prompt: str) -> str:
+    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    response = client.chat.completions.create(
+        messages=[{"role": "user", "content": prompt}],
+        response_format={"type": "json_object"},
+        model=model,
+    )
+    return response.choices[0].message.content
+
+
+def _run(generate_fn) -> dict[str, float]:
+    _StubHandler.connections.clear()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=_THREADS.value) as executor:
+        list(
+            executor.map(
+                lambda _: generate_fn(model="gpt-stub", prompt="bid"),
+                range(_CALLS.value),
+            )
+        )
+    elapsed = time.perf_counter() - start
+    return {
+        "total_s": elapsed,
+        "per_call_ms": elapsed / _CALLS.value * 1000,
+        "connections": len(_StubHandler.connections),
+    }
+
+
+def main(_):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+
+    try:
+        apis.clear_clients()
+        results = {
+            "per_call_client": _run(_generate_per_call_client),
+            "shared_client": _run(apis.generate_openai),
+        }
+    finally:
+        server.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    absl_app.run(main)
@@ -0,0 +1,271 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs complete games against the mock model and reports where time goes.
+
+For every game it records the wall time, the time spent in each phase, the
+LLM calls per round, the bytes of prompts rendered and the time taken by
+`logging.save_game`. The results are printed as JSON, and optionally written
+to `--output`, so they can be compared across commits.
+
+    python3 -m benchmarks.bench_game --games=3 --model=mock:latency=200ms
+
+The runner's flags apply too, e.g. `--speculative_debate=2`.
+"""
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import io
+import json
+import random
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Any, Dict
+
+from absl import app as absl_app
+from absl import flags
+
+from werewolf import apis
+from werewolf import game
+from werewolf import lm
+from werewolf import logging
+from werewolf import mock
+from werewolf import runner
+from werewolf.model import State
+
+_GAMES = flags.DEFINE_integer("games", 3, "Number of games to run.")
+_MODEL = flags.DEFINE_string(
+    "model", "mock:latency=50ms", "Mock model used by every player."
+)
+_BENCH_THREADS = flags.DEFINE_integer(
+    "bench_threads", 8, "Threads used to fan out player actions."
+)
+_BENCH_SEED = flags.DEFINE_integer(
+    "bench_seed", 0, "Seed for role assignment and player order."
+)
+_OUTPUT = flags.DEFINE_string("output", "", "Optional path of the JSON report.")
+_VERBOSE = flags.DEFINE_boolean("verbose", False, "Show the game transcript.")
+
+
+class _Counters:
+    """Thread-safe counters shared by the instrumentation hooks."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = collections.Counter()
+
+    def add(self, key: str, value: float = 1):
+        with self.lock:
+            self.values[key] += value
+
+    def get(self, key: str) -> float:
+        with self.lock:
+            return self.values[key]
+
+
+class ProfiledGameMaster(game.GameMaster):
+    """GameMaster that times each phase of the game."""
+
+    def __init__(self, *args, counters: _Counters, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counters = counters
+        self.phase_time = collections.Counter()
+        self.calls_per_round = []
+        self._votes_this_round = []
+
+    def _timed(self, phase, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.phase_time[phase] += time.perf_counter() - start
+
+    def run_night_phase(self):
+        return self._timed("night", super().run_night_phase)
+
+    def get_next_speaker(self):
+        return self._timed("bidding", super().get_next_speaker)
+
+    def _run_exile_vote(self):
+        start = time.perf_counter()
+        try:
+            return super()._run_exile_vote()
+        finally:
+            self._votes_this_round.append(time.perf_counter() - start)
+
+    def _join_votes(self, pending):
+        return self._timed("synthetic_votes", super()._join_votes, pending)
+
+    def run_day_phase(self):
+        self._votes_this_round = []
+        bidding = self.phase_time["bidding"]
+        synthetic = self.phase_time["synthetic_votes"]
+        start = time.perf_counter()
+        try:
+            super().run_day_phase()
+        finally:
+            day = time.perf_counter() - start
+            # The synthetic votes run in the background, so only the time spent
+            # waiting for them counts.
+            votes = sum(self._votes_this_round)
+            self.phase_time["final_vote"] += votes
+            self.phase_time["debate"] += (
+                day
+                - votes
+                - (self.phase_time["bidding"] - bidding)
+                - (self.phase_time["synthetic_votes"] - synthetic)
+            )
+
+    def run_summaries(self):
+        return self._timed("summaries", super().run_summaries)
+
+    def run_round(self):
+        calls = self.counters.get("llm_calls")
+        try:
+            super().run_round()
+        finally:
+            self.calls_per_round.append(
+                int(self.counters.get("llm_calls") - calls)
+            )
+
+
+def _instrument(counters: _Counters):
+    """Wraps the prompt rendering and the model calls to count them."""
+    format_prompt = lm.format_prompt
+    generate = apis.generate
+
+    def counting_format_prompt(prompt_template, worldstate):
+        prompt = format_prompt(prompt_template, worldstate)
+        counters.add("prompt_bytes", len(prompt.encode()))
+        return prompt
+
+    def counting_generate(model, **kwargs):
+        counters.add("llm_calls")
+        return generate(model, **kwargs)
+
+    lm.format_prompt = counting_format_prompt
+    apis.generate = counting_generate
+
+
+def _run_game(counters: _Counters, executor) -> Dict[str, Any]:
+    seed = random.getrandbits(32)
+    seer, doctor, villagers, werewolves = runner.initialize_players(
+        _MODEL.value, _MODEL.value, seed=seed
+    )
+    state = State(
+        session_id="benchmark",
+        seer=seer,
+        doctor=doctor,
+        villagers=villagers,
+        werewolves=werewolves,
+        seed=seed,
+    )
+    gm = ProfiledGameMaster(
+        state,
+        executor=executor,
+        counters=counters,
+        # Defined by werewolf.runner.
+        speculation_budget=flags.FLAGS.speculative_debate,
+    )
+
+    prompt_bytes = counters.get("prompt_bytes")
+    calls = counters.get("llm_calls")
+    error = ""
+    start = time.perf_counter()
+    try:
+        gm.run_game()
+    except Exception as e:
+        error = str(e)
+    wall_time = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        logging.save_game(state, gm.logs, directory)
+        save_time = time.perf_counter() - start
+
+    return {
+        "winner": state.winner,
+        "error": error,
+        "rounds": len(state.rounds),
+        "wall_time_s": wall_time,
+        "phase_time_s": dict(gm.phase_time),
+        "llm_calls": int(counters.get("llm_calls") - calls),
+        "llm_calls_per_round": gm.calls_per_round,
+        "prompt_bytes": int(counters.get("prompt_bytes") - prompt_bytes),
+        "save_game_s": save_time,
+        "speculation": dict(gm.speculation),
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main(_):
+    random.seed(_BENCH_SEED.value)
+    counters = _Counters()
+    _instrument(counters)
+
+    games = []
+    output = None if _VERBOSE.value else io.StringIO()
+    with (
+        contextlib.redirect_stdout(output)
+        if output
+        else contextlib.nullcontext()
+    ):
+        with ThreadPoolExecutor(max_workers=_BENCH_THREADS.value) as executor:
+            for _ in range(_GAMES.value):
+                games.append(_run_game(counters, executor))
+
+    phases = sorted({p for g in games for p in g["phase_time_s"]})
+    report = {
+        "commit": _git_commit(),
+        "model": _MODEL.value,
+        "threads": _BENCH_THREADS.value,
+        "games": games,
+        "summary": {
+            "wall_time_s": statistics.mean(g["wall_time_s"] for g in games),
+            "phase_time_s": {
+                p: statistics.mean(g["phase_time_s"].get(p, 0) for g in games)
+                for p in phases
+            },
+            "llm_calls_per_round": statistics.mean(
+                c for g in games for c in g["llm_calls_per_round"]
+            ),
+            "prompt_bytes": statistics.mean(g["prompt_bytes"] for g in games),
+            "save_game_s": statistics.mean(g["save_game_s"] for g in games),
+            "template_cache": lm.template_cache_info(),
+            "mock": mock.stats(),
+        },
+    }
+    print(json.dumps(report, indent=2))
+    if _OUTPUT.value:
+        with open(_OUTPUT.value, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    absl_app.run(main)
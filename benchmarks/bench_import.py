@@ -0,0 +1,121 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the import time of the engine's modules with `-X importtime`.
+
+Every module is imported in a fresh interpreter. The report lists the slowest
+imports, and fails if a module takes longer than `--budget_ms` or imports a
+provider SDK or pandas, which are only needed once a model is called or an
+eval report is written.
+
+    python3 -m benchmarks.bench_import
+
+`make bench-import` runs it with the default budget.
+"""
+
+import json
+import re
+import statistics
+import subprocess
+import sys
+from typing import Dict, List
+
+from absl import app as absl_app
+from absl import flags
+
+_MODULES = flags.DEFINE_list(
+    "modules",
+    ["werewolf.runner", "werewolf.mock", "werewolf.ratelimit"],
+    "Modules to import.",
+)
+_REPEAT = flags.DEFINE_integer(
+    "repeat", 5, "Number of fresh interpreters per module."
+)
+# werewolf.runner, the slowest module, takes about 120-150ms to import.
+_BUDGET_MS = flags.DEFINE_float(
+    "budget_ms", 300, "Maximum median import time per module. 0 disables it."
+)
+_TOP = flags.DEFINE_integer("top", 10, "Number of slowest imports reported.")
+
+# Imported lazily by werewolf.apis and werewolf.runner.
+LAZY_MODULES = ("openai", "anthropic", "vertexai", "google.auth", "pandas")
+
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def _import_times(module: str) -> Dict[str, int]:
+    """Returns the cumulative import time of `module` and of every module it
+    imports, in microseconds."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            entries.append(
+                (len(match.group(3)), match.group(4), int(match.group(2)))
+            )
+    # A module is reported after the modules it imports, which are indented
+    # further.
+    for i, (indent, name, _) in enumerate(entries):
+        if name == module:
+            start = i
+            while start > 0 and entries[start - 1][0] > indent:
+                start -= 1
+            return {name: us for _, name, us in entries[start : i + 1]}
+    raise SystemExit(f"{module} was already imported at startup.")
+
+
+def _eager_imports(times: Dict[str, int]) -> List[str]:
+    return sorted(
+        name
+        for name in times
+        if any(name == m or name.startswith(m + ".") for m in LAZY_MODULES)
+    )
+
+
+def main(_):
+    report = {}
+    failures = []
+    for module in _MODULES.value:
+        runs = [_import_times(module) for _ in range(_REPEAT.value)]
+        total_ms = statistics.median(run[module] for run in runs) / 1000
+        slowest = sorted(runs[-1].items(), key=lambda item: -item[1])
+        eager = _eager_imports(runs[-1])
+        report[module] = {
+            "import_ms": total_ms,
+            "slowest_ms": {
+                name: us / 1000 for name, us in slowest[1 : _TOP.value + 1]
+            },
+            "eager_imports": eager,
+        }
+        if eager:
+            failures.append(f"{module} imports {', '.join(eager[:5])}")
+        if _BUDGET_MS.value and total_ms > _BUDGET_MS.value:
+            failures.append(
+                f"{module} takes {total_ms:.0f}ms to import, over the"
+                f" {_BUDGET_MS.value:.0f}ms budget"
+            )
+
+    print(json.dumps(report, indent=2))
+    if failures:
+        raise SystemExit("\n".join(failures))
+
+
+if __name__ == "__main__":
+    absl_app.run(main)
@@ -0,0 +1,144 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the size and the speed of the log formats of `logging.save_game`.
+
+Every game directory under `--logs_dir` is saved in each log format and prompt
+format that `logging.save_game` supports, then loaded back with `logging.load_game`, which must give the same
+logs. Without recorded games, `--mock_games` games are played against the mock
+model. Prompts can only be logged as templates if they were, or if the game is
+played here, so use mock games to measure the template prompt format.
+
+    python3 -m benchmarks.bench_log_format --logs_dir=logs
+"""
+
+import contextlib
+import glob
+import io
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+import traceback
+
+from absl import app as absl_app
+from absl import flags
+
+from werewolf import game
+from werewolf import logging
+from werewolf import model
+from werewolf import runner
+
+_LOGS_DIR = flags.DEFINE_string(
+    "logs_dir", "", "Directory searched for recorded games."
+)
+_MOCK_GAMES = flags.DEFINE_integer(
+    "mock_games", 3, "Number of mock games played if --logs_dir is empty."
+)
+_REPEAT = flags.DEFINE_integer("repeat", 3, "Number of runs per format.")
+
+
+def _recorded_games() -> list:
+    pattern = os.path.join(_LOGS_DIR.value, "**", "game_*.json")
+    directories = sorted(
+        {os.path.dirname(path) for path in glob.glob(pattern, recursive=True)}
+    )
+    return [logging.load_game(directory) for directory in directories]
+
+
+def _mock_game() -> tuple:
+    seed = random.getrandbits(32)
+    with contextlib.redirect_stdout(io.StringIO()):
+        seer, doctor, villagers, werewolves = runner.initialize_players(
+            "mock", "mock", seed=seed
+        )
+        state = model.State(
+            session_id="benchmark",
+            seer=seer,
+            doctor=doctor,
+            villagers=villagers,
+            werewolves=werewolves,
+            seed=seed,
+        )
+        gm = game.GameMaster(state)
+        try:
+            gm.run_game()
+        except Exception:
+            # Saved like the runner saves a failed game.
+            state.error_message = traceback.format_exc()
+    return state, gm.logs
+
+
+def _measure(games: list, log_format: str, prompt_format: str) -> dict:
+    log_file = (
+        logging.COMPACT_LOG_FILE
+        if log_format == "compact"
+        else logging.LOG_FILE
+    )
+    save_times, load_times, size = [], [], 0
+    with tempfile.TemporaryDirectory() as root:
+        for i, (state, logs) in enumerate(games):
+            directory = os.path.join(root, str(i))
+            os.makedirs(directory)
+            for _ in range(_REPEAT.value):
+                start = time.perf_counter()
+                logging.save_game(
+                    state, logs, directory, log_format, prompt_format
+                )
+                save_times.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                _, loaded = logging.load_game(directory)
+                load_times.append(time.perf_counter() - start)
+            if model.to_dict(loaded) != model.to_dict(logs):
+                raise SystemExit(
+                    f"The {log_format} logs with {prompt_format} prompts don't"
+                    " round trip."
+                )
+            size += os.path.getsize(os.path.join(directory, log_file))
+    return {
+        "log_bytes": size,
+        "save_ms": statistics.median(save_times) * 1000,
+        "load_ms": statistics.median(load_times) * 1000,
+    }
+
+
+def main(_):
+    if _LOGS_DIR.value:
+        games = _recorded_games()
+        if not games:
+            raise SystemExit(f"No games found in {_LOGS_DIR.value}")
+    else:
+        random.seed(0)
+        games = [_mock_game() for _ in range(_MOCK_GAMES.value)]
+
+    report = {"games": len(games)}
+    for log_format in logging.LOG_FORMATS:
+        for prompt_format in logging.PROMPT_FORMATS:
+            if log_format == "json" and prompt_format == "template":
+                continue  # Not supported, see `logging.save_game`.
+            result = _measure(games, log_format, prompt_format)
+            if report.get("json_text"):
+                baseline = report["json_text"]
+                result["size_ratio"] = (
+                    baseline["log_bytes"] / result["log_bytes"]
+                )
+                result["save_speedup"] = baseline["save_ms"] / result["save_ms"]
+            report[f"{log_format}_{prompt_format}"] = result
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    absl_app.run(main)
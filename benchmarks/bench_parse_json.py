@@ -0,0 +1,112 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares `utils.parse_json` with the markdown/YAML-only parser.
+
+The corpus is every raw model response of the games under `--logs_dir`, read
+with `logging.load_game` in either log format.
+
+    python3 -m benchmarks.bench_parse_json --logs_dir=logs
+"""
+
+import glob
+import json
+import os
+import time
+from typing import Any, List
+
+from absl import app as absl_app
+from absl import flags
+
+from werewolf import logging
+from werewolf import utils
+from werewolf.model import to_dict
+
+_LOGS_DIR = flags.DEFINE_string(
+    "logs_dir", "logs", "Directory searched for game logs."
+)
+_REPEAT = flags.DEFINE_integer(
+    "repeat", 3, "Number of passes over the corpus per parser."
+)
+
+
+def _raw_responses(data: Any, corpus: List[str]):
+    """Collects the `raw_resp` of every LmLog in a game log."""
+    if isinstance(data, dict):
+        if isinstance(data.get("raw_resp"), str) and "prompt" in data:
+            corpus.extend(data["raw_resp"].split("-------"))
+        for value in data.values():
+            _raw_responses(value, corpus)
+    elif isinstance(data, list):
+        for value in data:
+            _raw_responses(value, corpus)
+
+
+def _markdown_then_yaml(text: str):
+    result_json = utils.parse_json_markdown(text)
+    if not result_json:
+        result_json = utils.parse_json_str(text)
+    return result_json
+
+
+def _time(parse, corpus: List[str]) -> float:
+    start = time.perf_counter()
+    for _ in range(_REPEAT.value):
+        for text in corpus:
+            try:
+                parse(text)
+            except Exception:
+                pass
+    return time.perf_counter() - start
+
+
+def _game_directories() -> List[str]:
+    directories = set()
+    for log_file in (logging.LOG_FILE, logging.COMPACT_LOG_FILE):
+        pattern = os.path.join(_LOGS_DIR.value, "**", log_file)
+        for path in glob.glob(pattern, recursive=True):
+            directories.add(os.path.dirname(path))
+    return sorted(directories)
+
+
+def main(_):
+    corpus = []
+    for directory in _game_directories():
+        _, logs = logging.load_game(directory)
+        _raw_responses(to_dict(logs), corpus)
+    if not corpus:
+        raise SystemExit(f"No model responses found in {_LOGS_DIR.value}")
+
+    baseline = _time(_markdown_then_yaml, corpus)
+    tiered = _time(utils.parse_json, corpus)
+    calls = len(corpus) * _REPEAT.value
+    print(
+        json.dumps(
+            {
+                "responses": len(corpus),
+                "markdown_yaml_us_per_call": baseline / calls * 1e6,
+                "tiered_us_per_call": tiered / calls * 1e6,
+                "speedup": baseline / tiered,
+                "tier_hits": {
+                    tier: hits // _REPEAT.value
+                    for tier, hits in utils.parse_json_stats().items()
+                },
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    absl_app.run(main)
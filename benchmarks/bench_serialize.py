@@ -0,0 +1,124 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares `model.to_dict` with a JSON encode/decode round trip.
+
+Both serialize the state and the logs of a recorded game, `--game`, or of a
+game played against the mock model. `--copies` repeats the game's rounds to
+make it larger. The report has the time and the peak memory of each.
+
+    python3 -m benchmarks.bench_serialize --game=logs/session_<id> --copies=10
+"""
+
+import contextlib
+import io
+import json
+import random
+import statistics
+import time
+import tracemalloc
+from typing import Any, Callable, Tuple
+
+from absl import app as absl_app
+from absl import flags
+
+from werewolf import game
+from werewolf import logging
+from werewolf import model
+from werewolf import runner
+
+_GAME = flags.DEFINE_string(
+    "game", "", "Log directory of a recorded game. Plays a mock game if empty."
+)
+_COPIES = flags.DEFINE_integer(
+    "copies", 1, "Number of times the game's rounds are repeated."
+)
+_REPEAT = flags.DEFINE_integer("repeat", 5, "Number of runs per serializer.")
+
+
+def _round_trip(o: Any) -> Any:
+    return json.loads(model.JsonEncoder().encode(o))
+
+
+def _mock_game() -> Tuple[model.State, list]:
+    seed = random.getrandbits(32)
+    with contextlib.redirect_stdout(io.StringIO()):
+        seer, doctor, villagers, werewolves = runner.initialize_players(
+            "mock", "mock", seed=seed
+        )
+        state = model.State(
+            session_id="benchmark",
+            seer=seer,
+            doctor=doctor,
+            villagers=villagers,
+            werewolves=werewolves,
+            seed=seed,
+        )
+        gm = game.GameMaster(state)
+        gm.run_game()
+    return state, gm.logs
+
+
+def _serialize(to_dict: Callable[[Any], Any], state, logs):
+    return to_dict(state), to_dict(logs)
+
+
+def _measure(to_dict: Callable[[Any], Any], state, logs) -> dict:
+    times = []
+    for _ in range(_REPEAT.value):
+        start = time.perf_counter()
+        _serialize(to_dict, state, logs)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    _serialize(to_dict, state, logs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"time_ms": statistics.median(times) * 1000, "peak_mb": peak / 1e6}
+
+
+def main(_):
+    random.seed(0)
+    if _GAME.value:
+        state, logs = logging.load_game(_GAME.value)
+    else:
+        state, logs = _mock_game()
+    state.rounds *= _COPIES.value
+    logs *= _COPIES.value
+
+    if _serialize(_round_trip, state, logs) != _serialize(
+        model.to_dict, state, logs
+    ):
+        raise SystemExit("to_dict doesn't match the JSON round trip.")
+
+    round_trip = _measure(_round_trip, state, logs)
+    direct = _measure(model.to_dict, state, logs)
+    print(
+        json.dumps(
+            {
+                "rounds": len(state.rounds),
+                "json_bytes": len(
+                    json.dumps(_serialize(model.to_dict, state, logs))
+                ),
+                "round_trip": round_trip,
+                "to_dict": direct,
+                "speedup": round_trip["time_ms"] / direct["time_ms"],
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    absl_app.run(main)
@@ -0,0 +1,329 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Exports the completed games of a logs tree as tables for analysis.
+
+`export` flattens every game into rows of these tables, keyed by the
+`session_id` column. That is the game's session id, or the name of its log
+directory for games logged before session ids were unique:
+
+  games    one row per game: winner, models, seed and number of rounds.
+  players  one row per player: role, model, and the round and way they were
+           removed from the game, if they were.
+  rounds   one row per round: who was eliminated, protected, unmasked or
+           exiled.
+  votes    one row per vote: the vote of the round, the voter, their choice
+           and both roles. The last vote of a round decides the exile.
+  bids     one row per bid: the debate turn, the player and the bid.
+  debate   one row per debate turn: the speaker and what they said.
+  calls    one row per model call: the phase, the player and the usage fields
+           of its `LmLog`.
+
+Each export writes one part of every table to `<out_dir>/<table>/`, as
+Parquet if pyarrow is installed and CSV otherwise, and then lists the part's
+log directories and sessions in `<out_dir>/exports.jsonl`. Directories listed
+there are skipped by the next export, so exports only add new games.
+`load_table` reads all the listed parts of a table into a pandas DataFrame:
+
+    analytics.export("logs", "logs/analytics")
+    votes = analytics.load_table("logs/analytics", "votes")
+"""
+
+import glob
+import importlib.util
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from werewolf import logging
+from werewolf.lm import USAGE_FIELDS
+from werewolf.model import WEREWOLF, State
+
+TABLES = ("games", "players", "rounds", "votes", "bids", "debate", "calls")
+FORMATS = ("parquet", "csv")
+EXPORTS_FILE = "exports.jsonl"
+
+Rows = Dict[str, List[Dict[str, Any]]]
+
+
+def default_format() -> str:
+    """Parquet if pyarrow is installed, CSV otherwise."""
+    return "parquet" if importlib.util.find_spec("pyarrow") else "csv"
+
+
+def _removals(state: State) -> Dict[str, tuple]:
+    """Returns the round and the way each removed player left the game."""
+    removals = {}
+    for number, game_round in enumerate(state.rounds):
+        if (
+            game_round.eliminated
+            and game_round.eliminated != game_round.protected
+        ):
+            removals[game_round.eliminated] = (number, "eliminated")
+        if game_round.exiled:
+            removals[game_round.exiled] = (number, "exiled")
+    return removals
+
+
+def _game_id(state: State, directory: str) -> str:
+    """Returns the session id of the game, unless the game was logged before
+    session ids were unique, in which case it is the directory name."""
+    name = os.path.basename(os.path.normpath(directory))
+    if name == f"session_{state.session_id}":
+        return state.session_id
+    return name
+
+
+def game_rows(directory: str) -> Rows:
+    """Flattens the game saved in `directory` into rows of every table."""
+    state, logs = logging.load_game(directory)
+    session = _game_id(state, directory)
+    roles = {name: player.role for name, player in state.players.items()}
+    rows = {table: [] for table in TABLES}
+
+    rows["games"].append(
+        {
+            "session_id": session,
+            "directory": directory,
+            "winner": state.winner,
+            "villager_model": state.seer.model,
+            "werewolf_model": state.werewolves[0].model,
+            "seed": state.seed,
+            "rounds": len(state.rounds),
+        }
+    )
+
+    removals = _removals(state)
+    for name, player in state.players.items():
+        removed_round, removed_by = removals.get(name, (None, None))
+        rows["players"].append(
+            {
+                "session_id": session,
+                "player": name,
+                "role": player.role,
+                "model": player.model,
+                "removed_round": removed_round,
+                "removed_by": removed_by,
+            }
+        )
+
+    for number, game_round in enumerate(state.rounds):
+        rows["rounds"].append(
+            {
+                "session_id": session,
+                "round": number,
+                "players": len(game_round.players),
+                "eliminated": game_round.eliminated,
+                "protected": game_round.protected,
+                "unmasked": game_round.unmasked,
+                "exiled": game_round.exiled,
+                "success": game_round.success,
+            }
+        )
+        for vote, votes in enumerate(game_round.votes):
+            for voter, target in votes.items():
+                rows["votes"].append(
+                    {
+                        "session_id": session,
+                        "round": number,
+                        "vote": vote,
+                        "final": vote == len(game_round.votes) - 1,
+                        "voter": voter,
+                        "voter_role": roles.get(voter),
+                        "target": target,
+                        "target_role": roles.get(target),
+                    }
+                )
+        for turn, bids in enumerate(game_round.bids):
+            for player, bid in bids.items():
+                rows["bids"].append(
+                    {
+                        "session_id": session,
+                        "round": number,
+                        "turn": turn,
+                        "player": player,
+                        "bid": bid,
+                    }
+                )
+        for turn, (player, dialogue) in enumerate(game_round.debate):
+            rows["debate"].append(
+                {
+                    "session_id": session,
+                    "round": number,
+                    "turn": turn,
+                    "player": player,
+                    "dialogue": dialogue,
+                }
+            )
+
+    # Werewolves eliminate as a team, see `model.usage_by_player`.
+    night_players = {
+        "eliminate": WEREWOLF,
+        "investigate": state.seer.name,
+        "protect": state.doctor.name,
+    }
+    for number, log in enumerate(logs):
+        for phase, player, lm_log in log.model_calls():
+            row = {
+                "session_id": session,
+                "round": number,
+                "phase": phase,
+                "player": player or night_players[phase],
+                "success": lm_log.result is not None,
+                "prompt_chars": len(lm_log.prompt),
+            }
+            row.update((key, getattr(lm_log, key)) for key in USAGE_FIELDS)
+            rows["calls"].append(row)
+    return rows
+
+
+def _read_exports(out_dir: str) -> List[dict]:
+    path = os.path.join(out_dir, EXPORTS_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def _completed_games(logs_dir: str) -> List[str]:
+    pattern = os.path.join(logs_dir, "**", "game_complete.json")
+    return sorted(
+        os.path.dirname(path) for path in glob.glob(pattern, recursive=True)
+    )
+
+
+def _write_part(frame, path: str, table_format: str):
+    # Written under a temporary name, so that a part is either complete or
+    # absent.
+    temporary = path + ".tmp"
+    if table_format == "parquet":
+        frame.to_parquet(temporary, index=False)
+    else:
+        frame.to_csv(temporary, index=False)
+    os.replace(temporary, path)
+
+
+def export(
+    logs_dir: str,
+    out_dir: str,
+    table_format: Optional[str] = None,
+    workers: Optional[int] = None,
+) -> int:
+    """Exports the completed games under `logs_dir` that `out_dir` doesn't
+    have yet.
+
+    Args:
+      logs_dir: Directory searched for games.
+      out_dir: Directory of the tables.
+      table_format: One of `FORMATS`. Defaults to `default_format()`.
+      workers: Number of processes reading the games. 1 reads them in this
+        process; None uses one per CPU.
+
+    Returns:
+      The number of games exported.
+    """
+    # pandas is slow to import and only needed here.
+    import pandas as pd
+
+    table_format = table_format or default_format()
+    if table_format not in FORMATS:
+        raise ValueError(f"Unknown table format: {table_format}")
+
+    exports = _read_exports(out_dir)
+    exported = {session for entry in exports for session in entry["sessions"]}
+    exported_directories = {
+        directory for entry in exports for directory in entry["directories"]
+    }
+    directories = [
+        directory
+        for directory in map(os.path.abspath, _completed_games(logs_dir))
+        if directory not in exported_directories
+    ]
+
+    rows = {table: [] for table in TABLES}
+    sessions = []
+    new_directories = []
+    if workers == 1:
+        games = map(game_rows, directories)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        games = pool.map(game_rows, directories, chunksize=16)
+    try:
+        for directory, game in zip(directories, games):
+            session = game["games"][0]["session_id"]
+            # Listed either way, so that the next export doesn't read it again.
+            new_directories.append(directory)
+            if session in exported:
+                print(
+                    f"Skipping {directory}: session {session} was already"
+                    " exported from another directory."
+                )
+                continue
+            exported.add(session)
+            sessions.append(session)
+            for table in TABLES:
+                rows[table].extend(game[table])
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if not new_directories:
+        return 0
+
+    export_id = logging.new_session_id()
+    for table in TABLES:
+        if not rows[table]:
+            continue
+        os.makedirs(os.path.join(out_dir, table), exist_ok=True)
+        _write_part(
+            pd.DataFrame(rows[table]),
+            os.path.join(out_dir, table, f"part_{export_id}.{table_format}"),
+            table_format,
+        )
+    # The parts only count once they are listed here.
+    record = {
+        "export_id": export_id,
+        "format": table_format,
+        "sessions": sessions,
+        "directories": new_directories,
+        "time": time.time(),
+    }
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, EXPORTS_FILE), "a") as file:
+        file.write(json.dumps(record) + "\n")
+    return len(sessions)
+
+
+def load_table(out_dir: str, table: str):
+    """Reads every exported part of a table into one pandas DataFrame."""
+    import pandas as pd
+
+    if table not in TABLES:
+        raise ValueError(f"Unknown table: {table}")
+    frames = []
+    for entry in _read_exports(out_dir):
+        path = os.path.join(
+            out_dir, table, f"part_{entry['export_id']}.{entry['format']}"
+        )
+        if not os.path.exists(path):
+            continue  # The export had no rows for this table.
+        if entry["format"] == "parquet":
+            frames.append(pd.read_parquet(path))
+        else:
+            frames.append(pd.read_csv(path))
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
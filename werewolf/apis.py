@@ -12,79 +12,348 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from openai import OpenAI
+import asyncio
+import dataclasses
 import os
+import threading
 
-from typing import Any
-import google
-import vertexai
-from vertexai.preview import generative_models
-from anthropic import AnthropicVertex
+from typing import TYPE_CHECKING, Any, Callable, Dict, Tuple
 
+from werewolf import mock
 
-def generate(model, **kwargs):
-    if "gpt" in model:
-        return generate_openai(model, **kwargs)
+# The provider SDKs take seconds to import, so each one is imported by the
+# functions that call its provider, on first use.
+if TYPE_CHECKING:
+    from vertexai.preview import generative_models
+
+ANTHROPIC_REGION = "us-east5"
+VERTEXAI_REGION = "us-central1"
+
+# Clients are created lazily for each (provider, model, region), and shared by
+# every thread so that their HTTP connection pools are reused across calls.
+_CLIENTS: Dict[Tuple[str, str, str], Any] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+_CREDENTIALS = None
+_PROJECT_ID = None
+_CREDENTIALS_LOCK = threading.Lock()
+
+
+@dataclasses.dataclass
+class Usage:
+    """Usage reported by the provider for one or more requests.
+
+    `input_tokens` counts the whole prompt, including `cached_input_tokens`.
+    """
+
+    backend: str = ""
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_input_tokens: int = 0
+
+    def add(self, other: "Usage"):
+        self.backend = other.backend
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.cached_input_tokens += other.cached_input_tokens
+
+
+def get_client(
+    provider: str, model: str, region: str, factory: Callable[[], Any]
+) -> Any:
+    """Returns the shared client for the key, creating it with `factory`.
+
+    The client is created outside the lock, as the factories may block on
+    network calls, so threads that race on a new key each create one and all
+    but the first are dropped.
+    """
+    key = (provider, model, region)
+    client = _CLIENTS.get(key)
+    if client is None:
+        client = factory()
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.setdefault(key, client)
+    return client
+
+
+async def aget_client(
+    provider: str, model: str, region: str, factory: Callable[[], Any]
+) -> Any:
+    """Async version of `get_client`.
+
+    A client that doesn't exist yet is created in a thread, as the factories
+    look up credentials and make blocking requests.
+    """
+    client = _CLIENTS.get((provider, model, region))
+    if client is None:
+        client = await asyncio.to_thread(
+            get_client, provider, model, region, factory
+        )
+    return client
+
+
+def clear_clients():
+    """Drops all cached clients and credentials."""
+    global _CREDENTIALS, _PROJECT_ID
+    with _CLIENTS_LOCK:
+        _CLIENTS.clear()
+    with _CREDENTIALS_LOCK:
+        _CREDENTIALS, _PROJECT_ID = None, None
+
+
+def get_credentials():
+    """Returns the application default credentials and project id.
+
+    The lookup runs once per process. The credentials are only refreshed when
+    they have expired (or were never populated with a token).
+    """
+    import google.auth
+    import google.auth.transport.requests
+
+    global _CREDENTIALS, _PROJECT_ID
+    with _CREDENTIALS_LOCK:
+        if _CREDENTIALS is None:
+            # For local development, run `gcloud auth application-default login`
+            # first to create the application default credentials, which will
+            # be picked up automatically here.
+            _CREDENTIALS, _PROJECT_ID = google.auth.default(
+                scopes=["https://www.googleapis.com/auth/cloud-platform"]
+            )
+        if not _CREDENTIALS.valid:
+            _CREDENTIALS.refresh(google.auth.transport.requests.Request())
+        return _CREDENTIALS, _PROJECT_ID
+
+
+async def aget_credentials():
+    """Async version of `get_credentials`; a lookup or refresh runs in a thread
+    so that it doesn't block the event loop."""
+    credentials = _CREDENTIALS
+    if credentials is not None and credentials.valid:
+        return credentials, _PROJECT_ID
+    return await asyncio.to_thread(get_credentials)
+
+
+def provider(model: str) -> str:
+    """Returns the name of the provider serving `model`."""
+    if mock.is_mock(model):
+        return "mock"
+    elif "gpt" in model:
+        return "openai"
     elif "claude" in model:
+        return "anthropic"
+    else:
+        return "vertexai"
+
+
+def generate(model, **kwargs) -> Tuple[str, Usage]:
+    """Sends the prompt to the provider of `model`.
+
+    Returns the text of the response and the usage of the request.
+    """
+    name = provider(model)
+    if name == "mock":
+        text, usage = mock.generate(model, **kwargs)
+        return text, Usage(backend="mock", **usage)
+    elif name == "openai":
+        return generate_openai(model, **kwargs)
+    elif name == "anthropic":
         return generate_authropic(model, **kwargs)
     else:
         return generate_vertexai(model, **kwargs)
 
 
-# openai
-def generate_openai(model: str, prompt: str, json_mode: bool = True, **kwargs):
-    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+async def agenerate(model, **kwargs) -> Tuple[str, Usage]:
+    """Async version of `generate` built on the providers' async clients."""
+    name = provider(model)
+    if name == "mock":
+        text, usage = await mock.agenerate(model, **kwargs)
+        return text, Usage(backend="mock", **usage)
+    elif name == "openai":
+        return await agenerate_openai(model, **kwargs)
+    elif name == "anthropic":
+        return await agenerate_authropic(model, **kwargs)
+    else:
+        return await agenerate_vertexai(model, **kwargs)
+
 
+# openai
+def _openai_request(model: str, prompt: str, json_mode: bool) -> dict[str, Any]:
     response_format = {"type": "text"}
     if json_mode:
         response_format = {"type": "json_object"}
-    response = client.chat.completions.create(
+    return dict(
         messages=[{"role": "user", "content": prompt}],
         response_format=response_format,
         model=model,
     )
 
+
+def _openai_usage(response) -> Usage:
+    usage = response.usage
+    if usage is None:
+        return Usage(backend="openai")
+    details = getattr(usage, "prompt_tokens_details", None)
+    return Usage(
+        backend="openai",
+        input_tokens=usage.prompt_tokens or 0,
+        output_tokens=usage.completion_tokens or 0,
+        cached_input_tokens=getattr(details, "cached_tokens", 0) or 0,
+    )
+
+
+def generate_openai(model: str, prompt: str, json_mode: bool = True, **kwargs):
+    from openai import OpenAI
+
+    client = get_client(
+        "openai",
+        model,
+        "",
+        lambda: OpenAI(api_key=os.environ.get("OPENAI_API_KEY")),
+    )
+
+    response = client.chat.completions.create(
+        **_openai_request(model, prompt, json_mode)
+    )
+
     txt = response.choices[0].message.content
-    return txt
+    return txt, _openai_usage(response)
+
+
+async def agenerate_openai(
+    model: str, prompt: str, json_mode: bool = True, **kwargs
+):
+    from openai import AsyncOpenAI
+
+    client = get_client(
+        "openai-async",
+        model,
+        "",
+        lambda: AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY")),
+    )
+
+    response = await client.chat.completions.create(
+        **_openai_request(model, prompt, json_mode)
+    )
+
+    return response.choices[0].message.content, _openai_usage(response)
 
 
 # anthropic
-def generate_authropic(model: str, prompt: str, **kwargs):
-    # For local development, run `gcloud auth application-default login` first to
-    # create the application default credentials, which will be picked up
-    # automatically here.
-    _, project_id = google.auth.default()
-    client = AnthropicVertex(region="us-east5", project_id=project_id)
+def _anthropic_content(prompt: str, cache_prefix: str) -> list[dict[str, Any]]:
+    """Marks the stable prefix of the prompt for prompt caching."""
+    if not cache_prefix or not prompt.startswith(cache_prefix):
+        return [{"type": "text", "text": prompt}]
+    return [
+        {
+            "type": "text",
+            "text": cache_prefix,
+            "cache_control": {"type": "ephemeral"},
+        },
+        {"type": "text", "text": prompt[len(cache_prefix) :]},
+    ]
+
+
+def _anthropic_usage(response) -> Usage:
+    usage = response.usage
+    cache_read = getattr(usage, "cache_read_input_tokens", 0) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", 0) or 0
+    return Usage(
+        backend="anthropic",
+        input_tokens=usage.input_tokens + cache_read + cache_write,
+        output_tokens=usage.output_tokens,
+        cached_input_tokens=cache_read,
+    )
+
+
+def generate_authropic(
+    model: str, prompt: str, cache_prefix: str = "", **kwargs
+):
+    from anthropic import AnthropicVertex
+
+    credentials, project_id = get_credentials()
+    client = get_client(
+        "anthropic",
+        model,
+        ANTHROPIC_REGION,
+        lambda: AnthropicVertex(
+            region=ANTHROPIC_REGION,
+            project_id=project_id,
+            credentials=credentials,
+        ),
+    )
 
     response = client.messages.create(
-        model=model, messages=[{"role": "user", "content": prompt}], max_tokens=1024
+        model=model,
+        messages=[
+            {
+                "role": "user",
+                "content": _anthropic_content(prompt, cache_prefix),
+            }
+        ],
+        max_tokens=1024,
     )
 
-    return response.content[0].text
+    return response.content[0].text, _anthropic_usage(response)
 
 
-# vertexai
-def generate_vertexai(
-    model: str,
-    prompt: str,
-    temperature: float = 0.7,
-    json_mode: bool = True,
-    json_schema: dict[str, Any] | None = None,
-    **kwargs,
-) -> str:
-    """Generates text content using Vertex AI."""
+async def agenerate_authropic(
+    model: str, prompt: str, cache_prefix: str = "", **kwargs
+):
+    from anthropic import AsyncAnthropicVertex
+
+    credentials, project_id = await aget_credentials()
+    client = await aget_client(
+        "anthropic-async",
+        model,
+        ANTHROPIC_REGION,
+        lambda: AsyncAnthropicVertex(
+            region=ANTHROPIC_REGION,
+            project_id=project_id,
+            credentials=credentials,
+        ),
+    )
+
+    response = await client.messages.create(
+        model=model,
+        messages=[
+            {
+                "role": "user",
+                "content": _anthropic_content(prompt, cache_prefix),
+            }
+        ],
+        max_tokens=1024,
+    )
 
-    # For local development, run `gcloud auth application-default login` first to
-    # create the application default credentials, which will be picked up
-    # automatically here.
-    credentials, project_id = google.auth.default()
+    return response.content[0].text, _anthropic_usage(response)
 
+
+# vertexai
+def _init_vertexai(model: str) -> "generative_models.GenerativeModel":
+    import vertexai
+    from vertexai.preview import generative_models
+
+    credentials, project_id = get_credentials()
+    # `vertexai.init` only updates global settings, so repeating it for another
+    # model is harmless.
     vertexai.init(
         project=project_id,
-        location="us-central1",
+        location=VERTEXAI_REGION,
         credentials=credentials,
     )
-    model_endpoint = generative_models.GenerativeModel(model)
+    return generative_models.GenerativeModel(model)
+
+
+def _vertexai_config(
+    model: str,
+    temperature: float,
+    json_mode: bool,
+    json_schema: dict[str, Any] | None,
+) -> tuple[
+    "generative_models.GenerationConfig",
+    list["generative_models.SafetySetting"],
+]:
+    """Returns the generation and safety config for a Vertex AI request."""
+    from vertexai.preview import generative_models
 
     # 1.5 flash doesn't support constrained decoding as of 6/5/2024, so we
     # disable json_schema for it. Otherwise, the library will throw an unsupported
@@ -120,6 +389,40 @@ def generate_vertexai(
             threshold=generative_models.HarmBlockThreshold.BLOCK_NONE,
         ),
     ]
+    return config, safety_config
+
+
+def _vertexai_usage(response: "generative_models.GenerationResponse") -> Usage:
+    usage = response.usage_metadata
+    return Usage(
+        backend="vertexai",
+        input_tokens=usage.prompt_token_count,
+        output_tokens=usage.candidates_token_count,
+        cached_input_tokens=getattr(usage, "cached_content_token_count", 0),
+    )
+
+
+def generate_vertexai(
+    model: str,
+    prompt: str,
+    temperature: float = 0.7,
+    json_mode: bool = True,
+    json_schema: dict[str, Any] | None = None,
+    **kwargs,
+) -> Tuple[str, Usage]:
+    """Generates text content using Vertex AI.
+
+    `cache_prefix` is ignored: Vertex AI context caches are created explicitly
+    and need far longer prompts than a game's.
+    """
+    from vertexai.preview import generative_models
+
+    model_endpoint = get_client(
+        "vertexai", model, VERTEXAI_REGION, lambda: _init_vertexai(model)
+    )
+    config, safety_config = _vertexai_config(
+        model, temperature, json_mode, json_schema
+    )
     response = model_endpoint.generate_content(
         prompt,
         generation_config=config,
@@ -128,4 +431,32 @@ def generate_vertexai(
     )
     assert isinstance(response, generative_models.GenerationResponse)
 
-    return response.text
+    return response.text, _vertexai_usage(response)
+
+
+async def agenerate_vertexai(
+    model: str,
+    prompt: str,
+    temperature: float = 0.7,
+    json_mode: bool = True,
+    json_schema: dict[str, Any] | None = None,
+    **kwargs,
+) -> Tuple[str, Usage]:
+    """Async version of `generate_vertexai`."""
+    from vertexai.preview import generative_models
+
+    model_endpoint = await aget_client(
+        "vertexai", model, VERTEXAI_REGION, lambda: _init_vertexai(model)
+    )
+    config, safety_config = _vertexai_config(
+        model, temperature, json_mode, json_schema
+    )
+    response = await model_endpoint.generate_content_async(
+        prompt,
+        generation_config=config,
+        stream=False,
+        safety_settings=safety_config,
+    )
+    assert isinstance(response, generative_models.GenerationResponse)
+
+    return response.text, _vertexai_usage(response)
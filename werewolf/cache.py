@@ -0,0 +1,180 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An on-disk, content-addressed cache of model responses.
+
+Responses are keyed by the model, the hash of the rendered prompt, the
+response schema, the temperature and the retry index, so re-running a game
+with the same seed sends no request twice. Failed requests are recorded too,
+which lets a replay take the same retries as the original game.
+
+The cache is a single SQLite database. It is safe to share between the threads
+of a process and, thanks to WAL mode, between processes. Once it grows past
+`max_bytes`, the least recently used responses are evicted.
+"""
+
+import collections
+import dataclasses
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+DEFAULT_MAX_BYTES = 1 << 30
+# Eviction frees space down to this fraction of `max_bytes`, so that it doesn't
+# run again on the next write.
+_EVICT_TO = 0.9
+
+
+class CacheMiss(RuntimeError):
+    """A request had no cached response in replay mode."""
+
+
+class CachedError(RuntimeError):
+    """A request that failed when its response was recorded."""
+
+
+@dataclasses.dataclass(frozen=True)
+class CachedResponse:
+    response: Optional[str]
+    error: Optional[str]
+
+
+def cache_key(
+    model: str,
+    prompt: str,
+    response_schema: Dict[str, Any],
+    temperature: float,
+    attempt: int,
+) -> str:
+    """Returns the cache key of a request."""
+    payload = json.dumps(
+        [
+            model,
+            hashlib.sha256(prompt.encode()).hexdigest(),
+            response_schema,
+            round(temperature, 6),
+            attempt,
+        ],
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """An LRU cache of model responses stored in SQLite."""
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+        self._db = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " model TEXT NOT NULL,"
+            " response TEXT,"
+            " error TEXT,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used"
+            " ON responses (last_used)"
+        )
+        self._size = self._total_size()
+
+    def _total_size(self) -> int:
+        return self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """Returns the cached response of `key` and marks it as used."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response, error FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+            self._db.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self._stats["hits"] += 1
+            return CachedResponse(response=row[0], error=row[1])
+
+    def put(
+        self,
+        key: str,
+        model: str,
+        response: Optional[str] = None,
+        error: Optional[str] = None,
+    ):
+        """Stores the response, or the error, of a request."""
+        size = len(key) + len((response or "").encode())
+        size += len((error or "").encode())
+        with self._lock:
+            previous = self._db.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses"
+                " (key, model, response, error, size, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, error, size, time.time()),
+            )
+            self._size += size - (previous[0] if previous else 0)
+            self._stats["writes"] += 1
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Other processes may share the database, so start from its real size.
+        self._size = self._total_size()
+        target = self.max_bytes * _EVICT_TO
+        if self._size <= target:
+            return
+        evicted = []
+        rows = self._db.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        )
+        for key, size in rows:
+            if self._size <= target:
+                break
+            evicted.append((key,))
+            self._size -= size
+        rows.close()
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self._stats["evictions"] += len(evicted)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the hits, misses, writes and evictions of this process."""
+        with self._lock:
+            return {**self._stats, "size_bytes": self._size}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -15,14 +15,31 @@
 import random
 
 RETRIES = 3
+# Throttled requests (HTTP 429) are retried this many times on top of RETRIES.
+RATE_LIMIT_RETRIES = 8
 NAMES = [
     "Derek", "Scott", "Jacob", "Isaac", "Hayley", "David", "Tyler",
     "Ginger", "Jackson", "Mason", "Dan", "Bert", "Will", "Sam",
     "Paul", "Leah", "Harold"
 ]  # names of famous Werewolves according to Wikipedia
 RUN_SYNTHETIC_VOTES = True
+# Synthetic votes are taken after every SYNTHETIC_VOTE_INTERVAL-th debate turn,
+# from a random SYNTHETIC_VOTE_FRACTION of the players, to save model calls.
+SYNTHETIC_VOTE_INTERVAL = 1
+SYNTHETIC_VOTE_FRACTION = 1.0
+# Whether the game goes on as soon as the votes cast decide the exile. The
+# remaining votes are still collected for the log.
+RESOLVE_EXILE_EARLY = False
 MAX_DEBATE_TURNS = 8
+# With speculative debate, a bidder's debate turn is started before the bidding
+# ends if they bid at least this much and no one has bid more so far.
+SPECULATION_MIN_BID = 2
 NUM_PLAYERS = 8
+# Whether the prompt prefix a player's calls share within a round is sent to
+# the providers for context caching; only OpenAI and Anthropic use it. Players
+# then keep the order of the remaining players for the round instead of
+# shuffling it for every prompt, which changes the games.
+CACHE_PROMPT_PREFIX = False
 
-def get_player_names(): 
-    return random.sample(NAMES, NUM_PLAYERS)
\ No newline at end of file
+def get_player_names(rng=random):
+    return rng.sample(NAMES, NUM_PLAYERS)
\ No newline at end of file
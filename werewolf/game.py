@@ -14,15 +14,25 @@
 
 """Werewolf game."""
 
+import asyncio
 from collections import Counter
-from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from concurrent.futures import FIRST_COMPLETED, Executor, ThreadPoolExecutor
+from concurrent.futures import as_completed, wait
+import functools
+import inspect
 import random
-from typing import List
+import threading
+from typing import List, Optional
 
 import tqdm
 
-from werewolf.model import Round, RoundLog, State, VoteLog
+from werewolf import lm
+from werewolf.logging import CheckpointWriter
+from werewolf.model import Round, RoundLog, State, VoteLog, Werewolf
 from werewolf.config import  MAX_DEBATE_TURNS, RUN_SYNTHETIC_VOTES
+from werewolf.config import RESOLVE_EXILE_EARLY, SPECULATION_MIN_BID
+from werewolf.config import SYNTHETIC_VOTE_FRACTION, SYNTHETIC_VOTE_INTERVAL
 
 def get_max_bids(d):
   """Gets all the keys with the highest value in the dictionary."""
@@ -31,21 +41,146 @@ def get_max_bids(d):
   return max_keys
 
 
+def exile_decided(votes, num_voters):
+  """Whether the votes cast so far decide the exile vote.
+
+  A player is exiled with more than half of the votes, so the outcome is
+  decided once a player has them, or once no player can get them.
+  """
+  top = max(Counter(votes.values()).values(), default=0)
+  votes_left = num_voters - len(votes)
+  return top > num_voters / 2 or top + votes_left <= num_voters / 2
+
+
+@contextlib.contextmanager
+def settle_on_error(tasks):
+  """If the block raises, cancels the tasks that haven't started and waits for
+  the others before the error propagates.
+
+  Player actions run on a long-lived executor, which nothing shuts down when
+  a phase fails, and an action still running would change its player while
+  the failed game is saved.
+  """
+  try:
+    yield
+  except BaseException:
+    for task in tasks:
+      task.cancel()
+    wait(tasks)
+    raise
+
+
+async def gather_settled(*aws):
+  """Like `asyncio.gather`, but if one of them raises, cancels the others and
+  waits for them before the error propagates; see `settle_on_error`."""
+  tasks = [asyncio.ensure_future(aw) for aw in aws]
+  try:
+    return await asyncio.gather(*tasks)
+  except BaseException:
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    raise
+
+
+def run_steps(steps):
+  """Runs a generator of steps to the end and returns its result.
+
+  The round methods of `GameMaster` are written once, as generators which
+  yield every call that waits on players: `run_steps` makes each call and
+  `arun_steps` also awaits it. Its result, or the error it raised, is sent
+  back into the generator.
+  """
+  send, value = steps.send, None
+  while True:
+    try:
+      step = send(value)
+    except StopIteration as stop:
+      return stop.value
+    try:
+      send, value = steps.send, step()
+    except BaseException as e:
+      send, value = steps.throw, e
+
+
+async def arun_steps(steps):
+  """Like `run_steps`, but awaits the steps that return an awaitable."""
+  send, value = steps.send, None
+  while True:
+    try:
+      step = send(value)
+    except StopIteration as stop:
+      return stop.value
+    try:
+      value = step()
+      if inspect.isawaitable(value):
+        value = await value
+      send = steps.send
+    except BaseException as e:
+      send, value = steps.throw, e
+
+
 class GameMaster:
 
   def __init__(
       self,
       state: State,
       num_threads: int = 1,
+      executor: Optional[Executor] = None,
+      checkpoint: Optional[CheckpointWriter] = None,
+      speculation_budget: int = 0,
   ) -> None:
     """Initialize the Werewolf game.
 
     Args:
+      state: The state of the game to run.
+      num_threads: Number of threads used to fan out player actions when no
+        executor is given.
+      executor: A long-lived executor shared across rounds and games. Its size
+        bounds the number of concurrent player actions of all the games using
+        it. The caller owns it and is responsible for shutting it down.
+      checkpoint: Where to append each round once it completes.
+      speculation_budget: Maximum number of debate turns generated per turn
+        while the bids are still coming in, for the likely next speakers. The
+        turns of the players who don't win the bid are discarded. 0 disables
+        speculation.
     """
     self.state = state
     self.current_round_num = len(self.state.rounds) if self.state.rounds else 0
     self.num_threads = num_threads
     self.logs: List[RoundLog] = []
+    self._executor = executor
+    self._owns_executor = executor is None
+    self.checkpoint = checkpoint
+    self.speculation_budget = speculation_budget
+    # started, used, cancelled (never sent), wasted (sent but discarded) and
+    # the wasted_input_tokens and wasted_output_tokens of those.
+    self.speculation = Counter()
+    self._speculation_lock = threading.Lock()
+    self._speculative_debates = {}
+    self._top_bid = -1
+    # The exile vote, while some of its votes are still running, and the
+    # announcements held back until those players' votes are in.
+    self._exile_vote = None
+    self._late_votes = {}
+    self._late_announcements = {}
+    # Games without a seed draw one, so that they still follow `random.seed`.
+    seed = state.seed if state.seed is not None else random.getrandbits(32)
+    self.rng = random.Random(seed)
+    for player in state.players.values():
+      player.set_seed(f"{seed}:{player.name}")
+
+  @property
+  def executor(self) -> Executor:
+    if self._executor is None:
+      self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+    return self._executor
+
+  def close(self):
+    """Shuts down the executor if it was created by this game master."""
+    if self._owns_executor and self._executor is not None:
+      self._executor.shutdown()
+      self._executor = None
 
   @property
   def this_round(self) -> Round:
@@ -55,13 +190,12 @@ class GameMaster:
   def this_round_log(self) -> RoundLog:
     return self.logs[self.current_round_num]
 
-  def eliminate(self):
-    """Werewolves choose a player to eliminate."""
-    werewolves_alive = [
+  def _werewolves_alive(self) -> List[Werewolf]:
+    return [
         w for w in self.state.werewolves if w.name in self.this_round.players
     ]
-    wolf = random.choice(werewolves_alive)
-    eliminated, log = wolf.eliminate()
+
+  def _record_eliminate(self, wolf, werewolves_alive, eliminated, log):
     self.this_round_log.eliminate = log
     if eliminated is not None:
       self.this_round.eliminated = eliminated
@@ -75,12 +209,7 @@ class GameMaster:
     else:
       raise ValueError("Eliminate did not return a valid player.")
 
-  def protect(self):
-    """Doctor chooses a player to protect."""
-    if self.state.doctor.name not in self.this_round.players:
-      return  # Doctor no longer in the game
-
-    protect, log = self.state.doctor.save()
+  def _record_protect(self, protect, log):
     self.this_round_log.protect = log
 
     if protect is not None:
@@ -89,12 +218,7 @@ class GameMaster:
     else:
       raise ValueError("Protect did not return a valid player.")
 
-  def unmask(self):
-    """Seer chooses a player to unmask."""
-    if self.state.seer.name not in self.this_round.players:
-      return  # Seer no longer in the game
-
-    unmask, log = self.state.seer.unmask()
+  def _record_unmask(self, unmask, log):
     self.this_round_log.investigate = log
 
     if unmask is not None:
@@ -103,10 +227,40 @@ class GameMaster:
     else:
       raise ValueError("Unmask function did not return a valid player.")
 
-  def _get_bid(self, player_name):
-    """Gets the bid for a specific player."""
-    player = self.state.players[player_name]
-    bid, log = player.bid()
+  def _night_actions(self):
+    """Returns the night actions of the players still in the game.
+
+    Each action is (act, aact, record): `act` (or its async version `aact`)
+    asks the player for a choice, and `record` applies it to the game. They are
+    in the order they are recorded: eliminate, protect, unmask.
+    """
+    werewolves_alive = self._werewolves_alive()
+    wolf = self.rng.choice(werewolves_alive)
+    actions = [(
+        wolf.eliminate,
+        wolf.aeliminate,
+        functools.partial(self._record_eliminate, wolf, werewolves_alive),
+    )]
+    doctor, seer = self.state.doctor, self.state.seer
+    if doctor.name in self.this_round.players:
+      actions.append((doctor.save, doctor.asave, self._record_protect))
+    if seer.name in self.this_round.players:
+      actions.append((seer.unmask, seer.aunmask, self._record_unmask))
+    return actions
+
+  def run_night_phase(self):
+    """The Werewolves, the Doctor and the Seer act at the same time.
+
+    None of them learns the others' choices before the night is resolved, so
+    their choices are requested concurrently, then recorded in order.
+    """
+    actions = self._night_actions()
+    tasks = [self.executor.submit(act) for act, _, _ in actions]
+    with settle_on_error(tasks):
+      for (_, _, record), task in zip(actions, tasks):
+        record(*task.result())
+
+  def _check_bid(self, player_name, bid):
     if bid is None:
       raise ValueError(
           f"{player_name} did not return a valid bid. Find the raw response"
@@ -114,31 +268,47 @@ class GameMaster:
       )
     if bid > 1:
       tqdm.tqdm.write(f"{player_name} bid: {bid}")
+
+  def _get_bid(self, player_name):
+    """Gets the bid for a specific player."""
+    player = self.state.players[player_name]
+    bid, log = player.bid()
+    self._check_bid(player_name, bid)
     return bid, log
 
-  def get_next_speaker(self):
-    """Determine the next speaker based on bids."""
+  def _bidders(self):
+    """Returns the previous turn of the debate and who bids for the next."""
     previous_speaker, previous_dialogue = (
         self.this_round.debate[-1] if self.this_round.debate else (None, None)
     )
+    bidders = [
+        player_name
+        for player_name in self.this_round.players
+        if player_name != previous_speaker
+    ]
+    return previous_dialogue, bidders
 
-    with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
-      player_bids = {
-          player_name: executor.submit(self._get_bid, player_name)
-          for player_name in self.this_round.players
-          if player_name != previous_speaker
-      }
-
-      bid_log = []
-      bids = {}
-      try:
-        for player_name, bid_task in player_bids.items():
-          bid, log = bid_task.result()
-          bids[player_name] = bid
-          bid_log.append((player_name, log))
-      except TypeError as e:
-        print(e)
-        raise e
+  def _record_bids(self, bidders, results, previous_dialogue):
+    """Records the bids in player order and picks the next speaker.
+
+    Args:
+      bidders: Names of the players who bid.
+      results: (bid, log) for every bidder, in the same order. It may be a lazy
+        iterable; it is consumed in order.
+      previous_dialogue: What was said in the previous turn of the debate.
+
+    Returns:
+      The name of the next speaker.
+    """
+    bid_log = []
+    bids = {}
+    try:
+      for player_name, (bid, log) in zip(bidders, results):
+        bids[player_name] = bid
+        bid_log.append((player_name, log))
+    except TypeError as e:
+      print(e)
+      raise e
 
     self.this_round.bids.append(bids)
     self.this_round_log.bid.append(bid_log)
@@ -150,80 +320,372 @@ class GameMaster:
           [name for name in potential_speakers if name in previous_dialogue]
       )
 
-    random.shuffle(potential_speakers)
-    return random.choice(potential_speakers)
+    self.rng.shuffle(potential_speakers)
+    return self.rng.choice(potential_speakers)
+
+  def _should_speculate(self, bid) -> bool:
+    """Whether to start a bidder's debate turn before the bidding ends.
+
+    Only bids of at least SPECULATION_MIN_BID that no earlier bid beats are
+    speculated on, up to the budget.
+    """
+    top_bid, self._top_bid = self._top_bid, max(self._top_bid, bid)
+    if (
+        len(self._speculative_debates) >= self.speculation_budget
+        or bid < SPECULATION_MIN_BID
+        or bid < top_bid
+    ):
+      return False
+    self._count_speculation("started")
+    return True
+
+  def _count_speculation(self, key, value=1):
+    # Speculative turns that finish after they are discarded are counted from
+    # the executor's threads.
+    with self._speculation_lock:
+      self.speculation[key] += value
+
+  def _count_wasted(self, log):
+    self._count_speculation("wasted_input_tokens", log.input_tokens)
+    self._count_speculation("wasted_output_tokens", log.output_tokens)
+
+  def _count_wasted_task(self, task):
+    if task.exception() is None:
+      self._count_wasted(task.result()[1])
+
+  def _discard_speculative_debates(self):
+    """Drops the debate turns started for players who didn't get to speak."""
+    for task in self._speculative_debates.values():
+      if task.cancel():
+        self._count_speculation("cancelled")
+        continue
+      self._count_speculation("wasted")
+      task.add_done_callback(self._count_wasted_task)
+    self._speculative_debates = {}
+
+  def _debate(self, speaker):
+    """Gets the speaker's turn, from the speculative debates if started."""
+    speculative = self._speculative_debates.pop(speaker, None)
+    self._discard_speculative_debates()
+    if speculative is None:
+      return self.state.players[speaker].debate()
+    self._count_speculation("used")
+    return speculative.result()
+
+  def _speculate(self, bidders, player_bids):
+    """Starts debate turns for the likely speakers as their bids arrive."""
+    self._top_bid = -1
+    names = dict(zip(player_bids, bidders))
+    for task in as_completed(player_bids):
+      if task.exception() is not None:
+        continue  # Raised again when the bids are recorded.
+      bid, _ = task.result()
+      if self._should_speculate(bid):
+        player = self.state.players[names[task]]
+        self._speculative_debates[names[task]] = self.executor.submit(
+            player.debate
+        )
+
+  def get_next_speaker(self):
+    """Determine the next speaker based on bids."""
+    previous_dialogue, bidders = self._bidders()
+    player_bids = [
+        self.executor.submit(self._get_bid, player_name)
+        for player_name in bidders
+    ]
+    with settle_on_error(player_bids):
+      if self.speculation_budget:
+        self._speculate(bidders, player_bids)
+      return self._record_bids(
+          bidders, (task.result() for task in player_bids), previous_dialogue
+      )
+
+  def _record_summary(self, player_name, summary, log):
+    tqdm.tqdm.write(f"{player_name} summary: {summary}")
+    self.this_round_log.summaries.append((player_name, log))
 
   def run_summaries(self):
     """Collect summaries from players after the debate."""
 
-    with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
-      player_summaries = {
-          name: executor.submit(self.state.players[name].summarize)
-          for name in self.this_round.players
-      }
+    player_summaries = {
+        name: self.executor.submit(self._summarize, name)
+        for name in self.this_round.players
+    }
 
+    with settle_on_error(list(player_summaries.values())):
       for player_name, summary_task in player_summaries.items():
         summary, log = summary_task.result()
-        tqdm.tqdm.write(f"{player_name} summary: {summary}")
-        self.this_round_log.summaries.append((player_name, log))
+        self._record_summary(player_name, summary, log)
 
-  def run_day_phase(self):
-    """Run the day phase which consists of the debate and voting."""
-
-    for idx in range(MAX_DEBATE_TURNS):
-      next_speaker = self.get_next_speaker()
-      if not next_speaker:
-        raise ValueError("get_next_speaker did not return a valid player.")
+  def _summarize(self, player_name):
+    """Gets a player's summary once their exile vote is in."""
+    self._join_late_vote(player_name)
+    return self.state.players[player_name].summarize()
 
-      player = self.state.players[next_speaker]
-      dialogue, log = player.debate()
-      if dialogue is None:
-        raise ValueError(
-            f"{next_speaker} did not return a valid dialouge from debate()."
-        )
+  def _record_debate(self, next_speaker, dialogue, log):
+    """Records a turn of the debate and shares it with every player."""
+    player = self.state.players[next_speaker]
+    if dialogue is None:
+      raise ValueError(
+          f"{next_speaker} did not return a valid dialouge from debate()."
+      )
 
-      self.this_round_log.debate.append((next_speaker, log))
-      self.this_round.debate.append([next_speaker, dialogue])
-      tqdm.tqdm.write(f"{next_speaker} ({player.role}): {dialogue}")
+    self.this_round_log.debate.append((next_speaker, log))
+    self.this_round.debate.append([next_speaker, dialogue])
+    tqdm.tqdm.write(f"{next_speaker} ({player.role}): {dialogue}")
 
-      for name in self.this_round.players:
-        player = self.state.players[name]
-        if player.gamestate:
-          player.gamestate.update_debate(next_speaker, dialogue)
-        else:
-          raise ValueError(f"{name}.gamestate needs to be initialized.")
+    for name in self.this_round.players:
+      player = self.state.players[name]
+      if player.gamestate:
+        player.gamestate.update_debate(next_speaker, dialogue)
+      else:
+        raise ValueError(f"{name}.gamestate needs to be initialized.")
 
-      if idx == MAX_DEBATE_TURNS - 1 or RUN_SYNTHETIC_VOTES:
-        votes, vote_logs = self.run_voting()
-        self.this_round.votes.append(votes)
-        self.this_round_log.votes.append(vote_logs)
+  def _record_votes(self, votes, vote_logs):
+    self.this_round.votes.append(votes)
+    self.this_round_log.votes.append(vote_logs)
 
+  def _report_final_votes(self):
     for player, vote in self.this_round.votes[-1].items():
       tqdm.tqdm.write(f"{player} voted to remove {vote}")
 
-  def run_voting(self):
-    """Conduct a vote among players to exile someone."""
+  def _synthetic_voters(self, turn):
+    """Returns who votes after a debate turn, in player order."""
+    if not RUN_SYNTHETIC_VOTES or (turn + 1) % SYNTHETIC_VOTE_INTERVAL:
+      return []
+    players = list(self.this_round.players)
+    if SYNTHETIC_VOTE_FRACTION >= 1:
+      return players
+    sample = self.rng.sample(
+        players, max(1, round(len(players) * SYNTHETIC_VOTE_FRACTION))
+    )
+    return [name for name in players if name in sample]
+
+  def run_day_phase(self):
+    """Run the day phase which consists of the debate and voting.
+
+    The synthetic votes after a debate turn run in the background while the
+    next turn is bid for and spoken, and are recorded before that turn.
+    """
+    return run_steps(self._day_phase_steps())
+
+  def _day_phase_steps(self):
+    pending_votes = None
+    try:
+      for idx in range(MAX_DEBATE_TURNS):
+        next_speaker = yield self.get_next_speaker
+        if not next_speaker:
+          raise ValueError("get_next_speaker did not return a valid player.")
+
+        dialogue, log = yield functools.partial(self._debate, next_speaker)
+        yield functools.partial(self._join_votes, pending_votes)
+        pending_votes = None
+        self._record_debate(next_speaker, dialogue, log)
+
+        if idx == MAX_DEBATE_TURNS - 1:
+          yield self._run_exile_vote
+          continue
+        voters = self._synthetic_voters(idx)
+        if voters:
+          pending_votes = self._start_votes(voters)
+    finally:
+      self._cancel_votes(pending_votes)
+      self._discard_speculative_debates()
+
+  def _tally_votes(self, voters, results):
+    """Collects the votes in player order.
+
+    Args:
+      voters: Names of the players who voted.
+      results: (vote, log) for every voter, in the same order. It may be a lazy
+        iterable; it is consumed in order.
+
+    Returns:
+      The votes and the vote logs.
+    """
     vote_log = []
     votes = {}
+    for player_name, (vote, log) in zip(voters, results):
+      vote_log.append(VoteLog(player_name, vote, log))
 
-    with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
-      player_votes = {
-          name: executor.submit(self.state.players[name].vote)
-          for name in self.this_round.players
-      }
+      if vote is not None:
+        votes[player_name] = vote
+      else:
+        self._record_votes(votes, vote_log)
+        raise ValueError(f"{player_name} vote did not return a valid player.")
 
-      for player_name, vote_task in player_votes.items():
-        vote, log = vote_task.result()
-        vote_log.append(VoteLog(player_name, vote, log))
+    return votes, vote_log
 
-        if vote is not None:
-          votes[player_name] = vote
-        else:
-          self.this_round.votes.append(votes)
-          self.this_round_log.votes.append(vote_log)
-          raise ValueError(f"{player_name} vote did not return a valid player.")
+  def _vote_requests(self, voters=None):
+    """Builds the vote requests of the voters on the current game state.
 
-    return votes, vote_log
+    They are built before the votes are sent, as the players' state changes
+    while synthetic votes run in the background.
+
+    Args:
+      voters: Names of the players who vote; all the players by default.
+    """
+    voters = list(voters or self.this_round.players)
+    return voters, [self.state.players[name].vote_request() for name in voters]
+
+  def _start_votes(self, voters=None):
+    """Starts a vote without waiting for it; see `_join_votes`."""
+    voters, requests = self._vote_requests(voters)
+    player_votes = [
+        self.executor.submit(self.state.players[name].vote, request)
+        for name, request in zip(voters, requests)
+    ]
+    return voters, player_votes
+
+  def _join_votes(self, pending):
+    """Waits for the votes started by `_start_votes` and records them."""
+    if pending is None:
+      return
+    voters, player_votes = pending
+    with settle_on_error(player_votes):
+      self._record_votes(
+          *self._tally_votes(voters, (task.result() for task in player_votes))
+      )
+
+  def _cancel_votes(self, pending):
+    """Cancels the votes started by `_start_votes` that haven't run yet."""
+    if pending is None:
+      return
+    for task in pending[1]:
+      task.cancel()
+
+  def _wait_first(self, tasks):
+    """Waits for the first of the tasks to finish; returns (done, pending)."""
+    return wait(tasks, return_when=FIRST_COMPLETED)
+
+  def _wait_all(self, tasks):
+    """Waits for all the tasks to finish, whether or not they fail."""
+    wait(tasks)
+
+  def _add_votes(self, votes, names, tasks):
+    """Adds the votes of finished tasks; returns False if one is invalid."""
+    for task in tasks:
+      if task.exception() is not None or task.result()[0] is None:
+        return False
+      votes[names[task]] = task.result()[0]
+    return True
+
+  def _hold_exile_vote(self, voters, player_votes, votes):
+    """Records the votes cast so far; `_record_exile_vote` records the rest.
+
+    Returns:
+      Whether the votes decide the exile while others are still running.
+    """
+    self._exile_vote = voters, player_votes
+    self._late_votes = {
+        name: task
+        for name, task in zip(voters, player_votes)
+        if name not in votes
+    }
+    self._record_votes(
+        {name: votes[name] for name in voters if name in votes}, []
+    )
+    return bool(votes) and bool(self._late_votes)
+
+  def _run_exile_vote(self):
+    """Takes the vote after the debate.
+
+    With RESOLVE_EXILE_EARLY, it returns as soon as the votes cast decide the
+    exile, and the other votes keep running: each player's summary waits for
+    their own vote, and announcements to them are held back until then, so
+    the game plays out the same.
+    """
+    return run_steps(self._exile_vote_steps())
+
+  def _exile_vote_steps(self):
+    voters, player_votes = self._start_votes()
+    votes = {}
+    pending = set(player_votes)
+    names = dict(zip(player_votes, voters))
+    while RESOLVE_EXILE_EARLY and pending:
+      done, pending = yield functools.partial(self._wait_first, pending)
+      if not self._add_votes(votes, names, done):
+        votes = {}
+        break
+      if exile_decided(votes, len(voters)):
+        break
+    if not self._hold_exile_vote(voters, player_votes, votes):
+      yield self._record_exile_vote
+
+  def _join_late_vote(self, player_name):
+    """Waits for a player's exile vote, then gives them held announcements."""
+    return run_steps(self._join_late_vote_steps(player_name))
+
+  def _join_late_vote_steps(self, player_name):
+    task = self._late_votes.pop(player_name, None)
+    if task is not None:
+      yield functools.partial(self._wait_all, [task])
+    for announcement in self._late_announcements.pop(player_name, []):
+      self.state.players[player_name].add_announcement(announcement)
+
+  def _record_exile_vote(self):
+    """Waits for the exile vote's remaining votes and records all of them.
+
+    A vote that failed or is invalid raises while the exile vote is still
+    held, so that `_close_exile_vote` records all the valid votes. Unlike the
+    other votes, this may happen after the exile was decided and applied.
+    """
+    return run_steps(self._record_exile_vote_steps())
+
+  def _record_exile_vote_steps(self):
+    if self._exile_vote is None:
+      return
+    voters, player_votes = self._exile_vote
+    for name in voters:
+      yield functools.partial(self._join_late_vote, name)
+    results = [task.result() for task in player_votes]
+    for player_name, (vote, _) in zip(voters, results):
+      if vote is None:
+        raise ValueError(f"{player_name} vote did not return a valid player.")
+    self._exile_vote = None
+    self.this_round.votes.pop()
+    self.this_round_log.votes.pop()
+    self._record_votes(*self._tally_votes(voters, results))
+    self._report_final_votes()
+
+  def _replace_held_votes(self, voters, player_votes):
+    """Replaces the held exile vote with every valid vote that finished."""
+    votes, vote_log = {}, []
+    for name, task in zip(voters, player_votes):
+      if task.cancelled() or task.exception() is not None:
+        continue
+      vote, log = task.result()
+      vote_log.append(VoteLog(name, vote, log))
+      if vote is not None:
+        votes[name] = vote
+    self.this_round.votes.pop()
+    self.this_round_log.votes.pop()
+    self._record_votes(votes, vote_log)
+
+  def _close_exile_vote(self):
+    """After an error, stops the exile vote's remaining votes and records the
+    votes cast, so that the round's votes and vote logs agree."""
+    return run_steps(self._close_exile_vote_steps())
+
+  def _close_exile_vote_steps(self):
+    if self._exile_vote is None:
+      return
+    voters, player_votes = self._exile_vote
+    self._exile_vote = None
+    for task in player_votes:
+      task.cancel()
+    # Waits for the votes already running, which change their player.
+    yield functools.partial(self._wait_all, player_votes)
+    for name in voters:
+      yield functools.partial(self._join_late_vote, name)
+    self._replace_held_votes(voters, player_votes)
+
+  def _announce(self, player_name, announcement):
+    """Tells a player, after their exile vote if it is still running."""
+    if player_name in self._late_votes:
+      self._late_announcements.setdefault(player_name, []).append(announcement)
+    else:
+      self.state.players[player_name].add_announcement(announcement)
 
   def exile(self):
     """Exile the player who received the most votes."""
@@ -251,7 +713,7 @@ class GameMaster:
       player = self.state.players[name]
       if player.gamestate and self.this_round.exiled is not None:
         player.gamestate.remove_player(self.this_round.exiled)
-      player.add_announcement(announcement)
+      self._announce(name, announcement)
 
     tqdm.tqdm.write(announcement)
 
@@ -274,8 +736,7 @@ class GameMaster:
         player.gamestate.remove_player(self.this_round.eliminated)
       player.add_announcement(announcement)
 
-  def run_round(self):
-    """Run a single round of the game."""
+  def _start_round(self):
     self.state.rounds.append(Round())
     self.logs.append(RoundLog())
 
@@ -285,30 +746,49 @@ class GameMaster:
         else self.state.rounds[self.current_round_num - 1].players.copy()
     )
 
-    for action, message in [
+  def _round_actions(self):
+    return [
         (
-            self.eliminate,
-            "The Werewolves are picking someone to remove from the game.",
+            self.run_night_phase,
+            "The Werewolves are picking someone to remove from the game, the"
+            " Doctor is protecting someone and the Seer is investigating"
+            " someone.",
         ),
-        (self.protect, "The Doctor is protecting someone."),
-        (self.unmask, "The Seer is investigating someone."),
         (self.resolve_night_phase, ""),
         (self.check_for_winner, "Checking for a winner after Night Phase."),
         (self.run_day_phase, "The Players are debating and voting."),
         (self.exile, ""),
         (self.check_for_winner, "Checking for a winner after Day Phase."),
         (self.run_summaries, "The Players are summarizing the debate."),
-    ]:
-      tqdm.tqdm.write(message)
-      action()
+    ]
 
-      if self.state.winner:
-        tqdm.tqdm.write(f"Round {self.current_round_num} is complete.")
-        self.this_round.success = True
-        return
+  def _write_checkpoint(self):
+    self.checkpoint.write_round(
+        self.state, self.this_round_log, self.current_round_num
+    )
+
+  def run_round(self):
+    """Run a single round of the game."""
+    return run_steps(self._round_steps())
 
+  def _round_steps(self):
+    self._start_round()
+
+    try:
+      for action, message in self._round_actions():
+        tqdm.tqdm.write(message)
+        yield action
+
+        if self.state.winner:
+          break
+
+      yield self._record_exile_vote
+    finally:
+      yield self._close_exile_vote
     tqdm.tqdm.write(f"Round {self.current_round_num} is complete.")
     self.this_round.success = True
+    if self.checkpoint:
+      yield self._write_checkpoint
 
   def get_winner(self) -> str:
     """Determine the winner of the game."""
@@ -326,18 +806,188 @@ class GameMaster:
     if self.state.winner:
       tqdm.tqdm.write(f"The winner is {self.state.winner}!")
 
+  def _advance_round(self):
+    for name in self.this_round.players:
+      if self.state.players[name].gamestate:
+        self.state.players[name].gamestate.round_number = (
+            self.current_round_num + 1
+        )
+        self.state.players[name].gamestate.clear_debate()
+    self.current_round_num += 1
+
   def run_game(self) -> str:
+    """Run the entire Werewolf game and return the winner."""
+    try:
+      while not self.state.winner:
+        tqdm.tqdm.write(f"STARTING ROUND: {self.current_round_num}")
+        self.run_round()
+        self._advance_round()
+    finally:
+      self.close()
+
+    tqdm.tqdm.write("Game is complete!")
+    return self.state.winner
+
+
+class AsyncGameMaster(GameMaster):
+  """A GameMaster that runs every player action on the asyncio event loop.
+
+  The game plays out exactly like `GameMaster`, but the bids, votes and
+  summaries of a turn are gathered as coroutines instead of being submitted to
+  threads, so one event loop can drive many concurrent games.
+  """
+
+  def __init__(
+      self,
+      state: State,
+      checkpoint: Optional[CheckpointWriter] = None,
+      speculation_budget: int = 0,
+  ) -> None:
+    super().__init__(
+        state, checkpoint=checkpoint, speculation_budget=speculation_budget
+    )
+
+  async def run_night_phase(self):
+    """The Werewolves, the Doctor and the Seer act at the same time."""
+    actions = self._night_actions()
+    results = await gather_settled(*[aact() for _, aact, _ in actions])
+    for (_, _, record), result in zip(actions, results):
+      record(*result)
+
+  async def _get_bid(self, player_name):
+    """Gets the bid for a specific player."""
+    player = self.state.players[player_name]
+    bid, log = await player.abid()
+    self._check_bid(player_name, bid)
+    return bid, log
+
+  def _discard_speculative_debates(self):
+    """Drops the debate turns started for players who didn't get to speak.
+
+    A turn still running is cancelled, and only counts as wasted if its
+    request was already sent; its tokens are unknown.
+    """
+    for task, sent in self._speculative_debates.values():
+      if not task.done():
+        task.cancel()
+        self._count_speculation("wasted" if sent.is_set() else "cancelled")
+        continue
+      self._count_speculation("wasted")
+      self._count_wasted_task(task)
+    self._speculative_debates = {}
+
+  async def _debate(self, speaker):
+    """Gets the speaker's turn, from the speculative debates if started."""
+    speculative = self._speculative_debates.pop(speaker, None)
+    self._discard_speculative_debates()
+    if speculative is None:
+      return await self.state.players[speaker].adebate()
+    self._count_speculation("used")
+    return await speculative[0]
+
+  async def _speculative_debate(self, player_name, sent):
+    with lm.track_sent(sent):
+      return await self.state.players[player_name].adebate()
+
+  async def _speculative_bid(self, player_name):
+    """Gets a bid, and starts the bidder's debate turn if they may win."""
+    bid, log = await self._get_bid(player_name)
+    if self.speculation_budget and self._should_speculate(bid):
+      sent = threading.Event()
+      self._speculative_debates[player_name] = (
+          asyncio.ensure_future(self._speculative_debate(player_name, sent)),
+          sent,
+      )
+    return bid, log
+
+  async def get_next_speaker(self):
+    """Determine the next speaker based on bids."""
+    previous_dialogue, bidders = self._bidders()
+    self._top_bid = -1
+    results = await gather_settled(
+        *[self._speculative_bid(player_name) for player_name in bidders]
+    )
+    return self._record_bids(bidders, results, previous_dialogue)
+
+  async def run_summaries(self):
+    """Collect summaries from players after the debate."""
+    names = list(self.this_round.players)
+    results = await gather_settled(*[self._summarize(name) for name in names])
+    for player_name, (summary, log) in zip(names, results):
+      self._record_summary(player_name, summary, log)
+
+  async def _summarize(self, player_name):
+    """Gets a player's summary once their exile vote is in."""
+    await self._join_late_vote(player_name)
+    return await self.state.players[player_name].asummarize()
+
+  async def run_day_phase(self):
+    """Run the day phase which consists of the debate and voting."""
+    return await arun_steps(self._day_phase_steps())
+
+  def _start_votes(self, voters=None):
+    """Starts a vote without waiting for it; see `_join_votes`."""
+    voters, requests = self._vote_requests(voters)
+    player_votes = [
+        asyncio.ensure_future(self.state.players[name].avote(request))
+        for name, request in zip(voters, requests)
+    ]
+    return voters, player_votes
+
+  async def _join_votes(self, pending):
+    """Waits for the votes started by `_start_votes` and records them."""
+    if pending is None:
+      return
+    voters, player_votes = pending
+    results = await gather_settled(*player_votes)
+    self._record_votes(*self._tally_votes(voters, results))
+
+  async def _wait_first(self, tasks):
+    """Waits for the first of the tasks to finish; returns (done, pending)."""
+    return await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+  async def _wait_all(self, tasks):
+    """Waits for all the tasks to finish, whether or not they fail."""
+    await asyncio.wait(tasks)
+
+  async def _run_exile_vote(self):
+    """Takes the vote after the debate; see `GameMaster._run_exile_vote`."""
+    return await arun_steps(self._exile_vote_steps())
+
+  async def _join_late_vote(self, player_name):
+    """Waits for a player's exile vote, then gives them held announcements."""
+    return await arun_steps(self._join_late_vote_steps(player_name))
+
+  async def _record_exile_vote(self):
+    """Waits for the exile vote's remaining votes and records all of them;
+    see `GameMaster._record_exile_vote`."""
+    return await arun_steps(self._record_exile_vote_steps())
+
+  async def _close_exile_vote(self):
+    """After an error, stops the exile vote's remaining votes and records the
+    votes cast; see `GameMaster._close_exile_vote`."""
+    return await arun_steps(self._close_exile_vote_steps())
+
+  async def run_round(self):
+    """Run a single round of the game."""
+    return await arun_steps(self._round_steps())
+
+  async def _write_checkpoint(self):
+    """Writes the checkpoint in a thread, as its fsync would block every game
+    on the event loop."""
+    await asyncio.to_thread(
+        self.checkpoint.write_round,
+        self.state,
+        self.this_round_log,
+        self.current_round_num,
+    )
+
+  async def run_game(self) -> str:
     """Run the entire Werewolf game and return the winner."""
     while not self.state.winner:
       tqdm.tqdm.write(f"STARTING ROUND: {self.current_round_num}")
-      self.run_round()
-      for name in self.this_round.players:
-        if self.state.players[name].gamestate:
-          self.state.players[name].gamestate.round_number = (
-              self.current_round_num + 1
-          )
-          self.state.players[name].gamestate.clear_debate()
-      self.current_round_num += 1
+      await self.run_round()
+      self._advance_round()
 
     tqdm.tqdm.write("Game is complete!")
     return self.state.winner
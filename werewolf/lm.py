@@ -12,29 +12,473 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import collections
+import contextlib
+import contextvars
 import dataclasses
+import hashlib
+import threading
+import time
 from typing import Any, Dict, List, Optional
 
 import jinja2
+from jinja2 import meta
 from werewolf import utils
 from werewolf.utils import Deserializable
 from werewolf import apis
-from werewolf.config import RETRIES
+from werewolf import cache
+from werewolf import ratelimit
+from werewolf.config import CACHE_PROMPT_PREFIX, RATE_LIMIT_RETRIES, RETRIES
+from werewolf.prompts import ACTION_PROMPTS_AND_SCHEMAS, PREFIX
 
 
 @dataclasses.dataclass
 class LmLog(Deserializable):
+    """A model call and its cost.
+
+    The usage fields cover every attempt of the call: `latency_s` is the time
+    spent in `generate`, `retries` the number of attempts after the first one
+    and `backend` the provider of the last attempt ("cache" if it was served
+    from the response cache).
+    """
+
     prompt: str
     raw_resp: str
     result: Any
+    model: str = ""
+    backend: str = ""
+    latency_s: float = 0.0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_input_tokens: int = 0
+    retries: int = 0
+    # Private, so that it isn't serialized with the other fields.
+    _prompt_source: Optional[Dict[str, Any]] = dataclasses.field(
+        default=None, repr=False, compare=False
+    )
+
+    @property
+    def prompt_source(self) -> Optional[Dict[str, Any]]:
+        """The template and worldstate the prompt was rendered from, if known.
+
+        See `prompt_source` and `render_prompt` in this module.
+        """
+        return self._prompt_source
 
     @classmethod
     def from_json(cls, data: Dict[Any, Any]):
+        prompt = data.get("prompt")
+        if isinstance(prompt, dict):
+            return cls(
+                **{**data, "prompt": render_prompt(prompt)},
+                _prompt_source=prompt,
+            )
         return cls(**data)
 
 
+# The LmLog fields that describe the cost of a call rather than its content.
+USAGE_FIELDS = (
+    "model",
+    "backend",
+    "latency_s",
+    "input_tokens",
+    "output_tokens",
+    "cached_input_tokens",
+    "retries",
+)
+
+
+@dataclasses.dataclass
+class UsageTotals:
+    """Totals of the usage fields of many LmLogs."""
+
+    calls: int = 0
+    latency_s: float = 0.0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_input_tokens: int = 0
+    retries: int = 0
+
+    def add(self, log: LmLog):
+        self.calls += 1
+        self.latency_s += log.latency_s
+        self.input_tokens += log.input_tokens
+        self.output_tokens += log.output_tokens
+        self.cached_input_tokens += log.cached_input_tokens
+        self.retries += log.retries
+
+    def merge(self, other: "UsageTotals"):
+        for field in dataclasses.fields(self):
+            setattr(
+                self,
+                field.name,
+                getattr(self, field.name) + getattr(other, field.name),
+            )
+
+
+# Templates are compiled once and shared by every player and thread. The
+# action prompts are compiled eagerly and keyed by action name; any other
+# template source is compiled on first use and keyed by its source text.
+_JINJA_ENV = jinja2.Environment()
+_TEMPLATES: Dict[str, jinja2.Template] = {
+    action: _JINJA_ENV.from_string(prompt_template)
+    for action, (prompt_template, _) in ACTION_PROMPTS_AND_SCHEMAS.items()
+}
+_TEMPLATE_KEYS: Dict[str, str] = {
+    prompt_template: action
+    for action, (prompt_template, _) in ACTION_PROMPTS_AND_SCHEMAS.items()
+}
+# Logged with prompts stored as their template, so that a prompt is never
+# rendered from a template that changed since.
+TEMPLATE_VERSIONS: Dict[str, str] = {
+    action: hashlib.sha256(prompt_template.encode()).hexdigest()[:16]
+    for action, (prompt_template, _) in ACTION_PROMPTS_AND_SCHEMAS.items()
+}
+# The worldstate variables each action prompt uses.
+_TEMPLATE_VARIABLES: Dict[str, frozenset] = {
+    action: frozenset(
+        meta.find_undeclared_variables(_JINJA_ENV.parse(prompt_template))
+    )
+    for action, (prompt_template, _) in ACTION_PROMPTS_AND_SCHEMAS.items()
+}
+_TEMPLATE_LOCK = threading.Lock()
+_TEMPLATE_STATS: collections.Counter = collections.Counter()
+
+
+def get_template(prompt_template: str) -> jinja2.Template:
+    """Returns the compiled template for the given template source."""
+    key = _TEMPLATE_KEYS.get(prompt_template, prompt_template)
+    with _TEMPLATE_LOCK:
+        template = _TEMPLATES.get(key)
+        if template is None:
+            template = _JINJA_ENV.from_string(prompt_template)
+            _TEMPLATES[key] = template
+            _TEMPLATE_STATS["misses"] += 1
+        else:
+            _TEMPLATE_STATS["hits"] += 1
+    return template
+
+
+def template_cache_info() -> Dict[str, int]:
+    """Returns the hit/miss counters of the template cache for profiling."""
+    with _TEMPLATE_LOCK:
+        return {
+            "hits": _TEMPLATE_STATS["hits"],
+            "misses": _TEMPLATE_STATS["misses"],
+            "size": len(_TEMPLATES),
+        }
+
+
 def format_prompt(prompt_template, worldstate) -> str:
-    return jinja2.Template(prompt_template).render(worldstate)
+    return get_template(prompt_template).render(worldstate)
+
+
+def prompt_source(
+    prompt_template: str, worldstate: Dict[str, Any]
+) -> Optional[Dict[str, Any]]:
+    """Returns what `render_prompt` needs to render the prompt again, or None
+    if the template isn't one of the action prompts."""
+    action = _TEMPLATE_KEYS.get(prompt_template)
+    if action is None:
+        return None
+    variables = _TEMPLATE_VARIABLES[action]
+    return {
+        "template": action,
+        "version": TEMPLATE_VERSIONS[action],
+        "worldstate": {k: v for k, v in worldstate.items() if k in variables},
+    }
+
+
+def render_prompt(source: Dict[str, Any]) -> str:
+    """Renders a prompt from the output of `prompt_source`."""
+    action = source["template"]
+    if TEMPLATE_VERSIONS.get(action) != source["version"]:
+        raise ValueError(
+            f"The {action} prompt was logged with version {source['version']}"
+            f" of its template, which isn't the current one."
+        )
+    return format_prompt(
+        ACTION_PROMPTS_AND_SCHEMAS[action][0], source["worldstate"]
+    )
+
+
+# The action prompts that start with `prompts.PREFIX`, compiled without it, so
+# that a prompt is rendered as its prefix and the rest.
+_PREFIX_TEMPLATE = _JINJA_ENV.from_string(PREFIX)
+_SUFFIX_TEMPLATES: Dict[str, jinja2.Template] = {
+    action: _JINJA_ENV.from_string(prompt_template[len(PREFIX) :])
+    for action, (prompt_template, _) in ACTION_PROMPTS_AND_SCHEMAS.items()
+    if prompt_template.startswith(PREFIX)
+}
+
+
+def split_prompt(
+    prompt_template: str, worldstate: Dict[str, Any]
+) -> tuple[str, str]:
+    """Renders a prompt as a stable prefix and a volatile suffix.
+
+    The prefix is the game rules, the player's state and observations
+    (`prompts.PREFIX`), which are identical for all of a player's prompts in a
+    round, so providers can cache it. Prompts whose template doesn't start with
+    it have an empty prefix.
+    """
+    suffix = _SUFFIX_TEMPLATES.get(_TEMPLATE_KEYS.get(prompt_template))
+    if suffix is None:
+        return "", format_prompt(prompt_template, worldstate)
+    return _PREFIX_TEMPLATE.render(worldstate), suffix.render(worldstate)
+
+
+def _render(prompt_template: str, worldstate: Dict[str, Any]):
+    """Returns the prompt and the prefix sent to providers for caching."""
+    if not CACHE_PROMPT_PREFIX:
+        return format_prompt(prompt_template, worldstate), ""
+    prefix, suffix = split_prompt(prompt_template, worldstate)
+    return prefix + suffix, prefix
+
+
+# Caps the number of LLM requests in flight across all games in the process.
+_REQUEST_SLOTS: Optional[threading.BoundedSemaphore] = None
+_ASYNC_REQUEST_SLOTS: Optional[asyncio.Semaphore] = None
+
+
+def set_max_concurrent_requests(limit: int) -> None:
+    """Limits the number of concurrent LLM requests. 0 removes the limit."""
+    global _REQUEST_SLOTS, _ASYNC_REQUEST_SLOTS
+    _REQUEST_SLOTS = threading.BoundedSemaphore(limit) if limit > 0 else None
+    _ASYNC_REQUEST_SLOTS = asyncio.Semaphore(limit) if limit > 0 else None
+
+
+def _request_slot():
+    return _REQUEST_SLOTS or contextlib.nullcontext()
+
+
+def _async_request_slot():
+    return _ASYNC_REQUEST_SLOTS or contextlib.nullcontext()
+
+
+# The event of the innermost `track_sent` block, if any.
+_SENT = contextvars.ContextVar("sent", default=None)
+
+
+@contextlib.contextmanager
+def track_sent(sent: threading.Event):
+    """Sets `sent` when a request made in the block gets its request slot,
+    i.e. from when cancelling it no longer saves the request."""
+    token = _SENT.set(sent)
+    try:
+        yield
+    finally:
+        _SENT.reset(token)
+
+
+def _mark_sent():
+    sent = _SENT.get()
+    if sent is not None:
+        sent.set()
+
+
+# Serves repeated requests from disk, see `set_response_cache`.
+_RESPONSE_CACHE: Optional[cache.ResponseCache] = None
+_REPLAY = False
+
+
+def set_response_cache(
+    response_cache: Optional[cache.ResponseCache], replay: bool = False
+) -> None:
+    """Caches the model responses in `response_cache`. None disables it.
+
+    With `replay`, a request that isn't cached raises `cache.CacheMiss` instead
+    of calling the model, and recorded failures are raised again so that the
+    game takes the same retries.
+    """
+    global _RESPONSE_CACHE, _REPLAY
+    _RESPONSE_CACHE = response_cache
+    _REPLAY = replay
+
+
+def get_response_cache() -> Optional[cache.ResponseCache]:
+    return _RESPONSE_CACHE
+
+
+def _cache_key(
+    model: str,
+    prompt: str,
+    response_schema: Dict[str, Any],
+    temperature: float,
+    attempt: int,
+) -> Optional[str]:
+    if _RESPONSE_CACHE is None:
+        return None
+    return cache.cache_key(model, prompt, response_schema, temperature, attempt)
+
+
+def _cached_response(key: Optional[str]) -> Optional[str]:
+    """Returns the cached response of `key`, or None to call the model."""
+    if key is None:
+        return None
+    entry = _RESPONSE_CACHE.get(key)
+    if _REPLAY:
+        if entry is None:
+            raise cache.CacheMiss(f"No cached response for request {key}.")
+        if entry.error is not None:
+            raise cache.CachedError(entry.error)
+    if entry is None or entry.error is not None:
+        return None
+    return entry.response
+
+
+def _cache_response(
+    key: Optional[str], model: str, raw_resp: Any = None, error: Any = None
+):
+    if key is None or isinstance(error, cache.CachedError):
+        return
+    _RESPONSE_CACHE.put(
+        key,
+        model,
+        response=None if raw_resp is None else str(raw_resp),
+        error=None if error is None else str(error),
+    )
+
+
+def _parse_response(
+    prompt: str, raw_resp: str, result_key: Optional[str]
+) -> tuple[Any, LmLog]:
+    result = utils.parse_json(raw_resp)
+    log = LmLog(prompt=prompt, raw_resp=raw_resp, result=result)
+
+    if result and result_key:
+        result = result.get(result_key)
+    return result, log
+
+
+class _Generation:
+    """The bookkeeping of a `generate` or `agenerate` call: the prompt, the
+    attempts, the cache, the rate limits and the usage of the LmLog.
+
+    `generate` and `agenerate` only differ in how they call the model and
+    wait, so they drive the same steps:
+
+        raw_resp = generation.cached_response()
+        if raw_resp is None:
+            raw_resp, usage = <call the model with generation.request()>
+            generation.record_call(request, raw_resp, usage)
+        done = generation.accept(raw_resp)
+
+    and on errors `record_error` says how long to wait and whether the
+    attempt counts. See `generate` for the arguments.
+    """
+
+    def __init__(
+        self,
+        prompt_template: str,
+        response_schema: Dict[str, Any],
+        worldstate: Dict[str, Any],
+        model: str,
+        temperature: float,
+        allowed_values: Optional[List[Any]],
+        result_key: Optional[str],
+    ):
+        self.prompt, self.cache_prefix = _render(prompt_template, worldstate)
+        self.source = prompt_source(prompt_template, worldstate)
+        self.response_schema = response_schema
+        self.model = model
+        self.temperature = temperature
+        self.allowed_values = allowed_values
+        self.result_key = result_key
+        self.provider = apis.provider(model)
+        self.tokens = ratelimit.estimate_tokens(self.prompt)
+        self.usage = apis.Usage()
+        self.start = time.perf_counter()
+        self.raw_responses = []
+        self.attempt = 0
+        self.throttles = 0
+        self.key = None
+
+    def cached_response(self) -> Optional[str]:
+        """Returns the cached response of this attempt, or None to call the
+        model."""
+        self.key = _cache_key(
+            self.model,
+            self.prompt,
+            self.response_schema,
+            self.temperature,
+            self.attempt,
+        )
+        raw_resp = _cached_response(self.key)
+        if raw_resp is not None:
+            self.usage.add(apis.Usage(backend="cache"))
+        return raw_resp
+
+    def request(self) -> Dict[str, Any]:
+        """The arguments of `apis.generate` and `apis.agenerate`."""
+        return dict(
+            model=self.model,
+            prompt=self.prompt,
+            cache_prefix=self.cache_prefix,
+            response_schema=self.response_schema,
+            temperature=self.temperature,
+            disable_recitation=True,
+            disable_safety_check=True,
+        )
+
+    def record_call(
+        self, request: ratelimit.Request, raw_resp: str, usage: apis.Usage
+    ):
+        request.record_tokens(usage.input_tokens + usage.output_tokens)
+        self.usage.add(usage)
+        _cache_response(self.key, self.model, raw_resp=raw_resp)
+
+    def accept(self, raw_resp: str) -> Optional[tuple[Any, LmLog]]:
+        """Returns the result and the log if the response is valid."""
+        result, log = _parse_response(self.prompt, raw_resp, self.result_key)
+        if self.allowed_values is None or result in self.allowed_values:
+            return result, self._record_usage(log, self.attempt + 1)
+        return None
+
+    def record_error(
+        self, e: Exception, raw_resp: Optional[str]
+    ) -> tuple[float, bool]:
+        """Returns how long to wait before the next try, and whether it
+        retries this attempt rather than counting it."""
+        if ratelimit.is_rate_limited(e) and self.throttles < RATE_LIMIT_RETRIES:
+            # Throttling says nothing about the prompt, so it doesn't use up an
+            # attempt.
+            self.throttles += 1
+            print(f"Throttled by {self.provider}, retrying: {e}")
+            return ratelimit.backoff(self.provider, self.throttles, e), True
+        if raw_resp is None:
+            _cache_response(self.key, self.model, error=e)
+        print(f"Retrying due to Exception: {e}")
+        failed = raw_resp is None and not isinstance(e, cache.CachedError)
+        if failed and self.attempt + 1 < RETRIES:
+            return ratelimit.backoff(self.provider, self.attempt + 1, e), False
+        return 0, False
+
+    def next_attempt(self, raw_resp: Optional[str]):
+        self.temperature = min(1.0, self.temperature + 0.2)
+        self.raw_responses.append(raw_resp)
+        self.attempt += 1
+
+    def failure(self) -> tuple[None, LmLog]:
+        """The result and the log once every attempt failed."""
+        log = LmLog(
+            prompt=self.prompt,
+            raw_resp="-------".join(str(r) for r in self.raw_responses),
+            result=None,
+        )
+        return None, self._record_usage(log, RETRIES)
+
+    def _record_usage(self, log: LmLog, attempts: int) -> LmLog:
+        log._prompt_source = self.source
+        log.model = self.model
+        log.backend = self.usage.backend
+        log.latency_s = time.perf_counter() - self.start
+        log.input_tokens = self.usage.input_tokens
+        log.output_tokens = self.usage.output_tokens
+        log.cached_input_tokens = self.usage.cached_input_tokens
+        log.retries = attempts - 1
+        return log
 
 
 def generate(
@@ -63,34 +507,83 @@ def generate(
     Returns:
         A tuple containing the result (or None if unsuccessful) and the LmLog.
     """
-
-    prompt = format_prompt(prompt_template, worldstate)
-    raw_responses = []
-    for _ in range(RETRIES):
+    generation = _Generation(
+        prompt_template,
+        response_schema,
+        worldstate,
+        model,
+        temperature,
+        allowed_values,
+        result_key,
+    )
+    while generation.attempt < RETRIES:
         raw_resp = None
         try:
-            raw_resp = apis.generate(
-                model=model,
-                prompt=prompt,
-                response_schema=response_schema,
-                temperature=temperature,
-                disable_recitation=True,
-                disable_safety_check=True,
-            )
-            result = utils.parse_json(raw_resp)
-            log = LmLog(prompt=prompt, raw_resp=raw_resp, result=result)
-
-            if result and result_key:
-                result = result.get(result_key)
-
-            if allowed_values is None or result in allowed_values:
-                return result, log
-
+            raw_resp = generation.cached_response()
+            if raw_resp is None:
+                limit = ratelimit.limit(generation.provider, generation.tokens)
+                with limit as request:
+                    with _request_slot():
+                        _mark_sent()
+                        raw_resp, usage = apis.generate(**generation.request())
+                generation.record_call(request, raw_resp, usage)
+            done = generation.accept(raw_resp)
+            if done is not None:
+                return done
+        except cache.CacheMiss:
+            raise
         except Exception as e:
-            print(f"Retrying due to Exception: {e}")
-        temperature = min(1.0, temperature + 0.2)
-        raw_responses.append(raw_resp)
+            delay, retry_attempt = generation.record_error(e, raw_resp)
+            if delay:
+                time.sleep(delay)
+            if retry_attempt:
+                continue
+        generation.next_attempt(raw_resp)
+    return generation.failure()
+
 
-    return None, LmLog(
-        prompt=prompt, raw_resp="-------".join(raw_responses), result=None
+async def agenerate(
+    prompt_template: str,
+    response_schema: Dict[str, Any],
+    worldstate: Dict[str, Any],
+    model: str,
+    temperature: float = 1.0,
+    allowed_values: Optional[List[Any]] = None,
+    result_key: Optional[str] = None,
+) -> tuple[Any, LmLog]:
+    """Async version of `generate`; see `generate` for the arguments."""
+    generation = _Generation(
+        prompt_template,
+        response_schema,
+        worldstate,
+        model,
+        temperature,
+        allowed_values,
+        result_key,
     )
+    while generation.attempt < RETRIES:
+        raw_resp = None
+        try:
+            raw_resp = generation.cached_response()
+            if raw_resp is None:
+                limit = ratelimit.alimit(generation.provider, generation.tokens)
+                async with limit as request:
+                    async with _async_request_slot():
+                        _mark_sent()
+                        raw_resp, usage = await apis.agenerate(
+                            **generation.request()
+                        )
+                generation.record_call(request, raw_resp, usage)
+            done = generation.accept(raw_resp)
+            if done is not None:
+                return done
+        except cache.CacheMiss:
+            raise
+        except Exception as e:
+            delay, retry_attempt = generation.record_error(e, raw_resp)
+            if delay:
+                await asyncio.sleep(delay)
+            if retry_attempt:
+                continue
+        generation.next_attempt(raw_resp)
+    return generation.failure()
@@ -12,19 +12,62 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import datetime
+import gzip
 import json
 import os
-from typing import List, Tuple
+import threading
+import time
+from typing import Any, Callable, List, Optional, Tuple
 
+from werewolf.lm import LmLog
 from werewolf.model import RoundLog, State, to_dict
 
+CHECKPOINT_FILE = "game_checkpoint.jsonl"
+LOG_FILE = "game_logs.json"
+COMPACT_LOG_FILE = "game_logs.jsonl.gz"
+# "json" is readable by the viewer; "compact" is several times smaller.
+LOG_FORMATS = ("json", "compact")
+# "text" logs the rendered prompts; "template" logs the template and worldstate
+# they were rendered from, as changes to the worldstate of the player's previous
+# call, and `load_game` renders them again. Only compact logs store templates.
+PROMPT_FORMATS = ("text", "template")
+_COMPACT_LOG_VERSION = 1
+# Number of earlier prompts searched for the longest prefix shared with a
+# prompt in the compact format.
+_PROMPT_WINDOW = 32
 
-def log_directory() -> str:
-    pacific_timezone = datetime.timezone(datetime.timedelta(hours=-8))
-    timestamp = datetime.datetime.now(pacific_timezone).strftime("%Y%m%d_%H%M%S")
-    session_id = f"session_{timestamp}"
-    directory = f"{os.getcwd()}/logs/{session_id}"
+# Crockford's base32, as used by ULIDs.
+_BASE32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+
+def new_session_id() -> str:
+    """Returns a new session id in the ULID format.
+
+    The first 10 characters encode the time in milliseconds and the last 16 are
+    random, so ids sort by creation time and don't collide across threads or
+    processes.
+    """
+    value = (time.time_ns() // 1_000_000) << 80
+    value |= int.from_bytes(os.urandom(10), "big")
+    chars = []
+    for _ in range(26):
+        value, index = divmod(value, 32)
+        chars.append(_BASE32[index])
+    return "".join(reversed(chars))
+
+
+def log_directory(session_id: Optional[str] = None) -> str:
+    """Creates and returns the log directory of a session.
+
+    The directory is created atomically, so a session never writes to the
+    directory of another one.
+
+    Args:
+      session_id: The id of the game; a new one by default.
+    """
+    directory = f"{os.getcwd()}/logs/session_{session_id or new_session_id()}"
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    os.mkdir(directory)
     return directory
 
 
@@ -40,26 +83,43 @@ def load_game(directory: str) -> Tuple[State, List[RoundLog]]:
 
     partial_game_state_file = f"{directory}/game_partial.json"
     complete_game_state_file = f"{directory}/game_complete.json"
-    log_file = f"{directory}/game_logs.json"
 
     game_state_file = partial_game_state_file
     if not os.path.exists(partial_game_state_file):
         game_state_file = complete_game_state_file
+    if not os.path.exists(game_state_file) and os.path.exists(
+        f"{directory}/{CHECKPOINT_FILE}"
+    ):
+        # The game never reached `save_game`, e.g. the process crashed.
+        return load_checkpoint(directory)
 
     with open(game_state_file, "r") as file:
         partial_game_data = json.load(file)
 
     state = State.from_json(partial_game_data)
+    if game_state_file == partial_game_state_file and os.path.exists(
+        f"{directory}/{CHECKPOINT_FILE}"
+    ):
+        # A resumed game checkpoints its rounds after the partial game was
+        # saved, so the checkpoint is newer if it crashed before saving again.
+        checkpoint = load_checkpoint(directory)
+        if len(checkpoint[0].rounds) > sum(r.success for r in state.rounds):
+            return checkpoint
 
-    with open(log_file, "r") as file:
-        logs = json.load(file)
-
+    logs = _read_logs(directory)
+    _map_prompts(logs, _WorldstateDeltas().decode, templates=True)
     logs = [RoundLog.from_json(log) for log in logs]
 
     return (state, logs)
 
 
-def save_game(state: State, logs: List[RoundLog], directory: str):
+def save_game(
+    state: State,
+    logs: List[RoundLog],
+    directory: str,
+    log_format: str = "json",
+    prompt_format: str = "text",
+):
     """Save the current game state to a specified file.
 
     This function serializes the game state to JSON and writes it to the
@@ -70,22 +130,412 @@ def save_game(state: State, logs: List[RoundLog], directory: str):
       state: Instance of the `State` class.
       logs: Logs of the  game.
       directory: where to save the game.
+      log_format: One of `LOG_FORMATS`. `load_game` reads either.
+      prompt_format: One of `PROMPT_FORMATS`. Prompts can only be logged as
+        templates in compact logs, as the viewer reads the prompts of
+        `LOG_FILE`.
     """
+    if prompt_format not in PROMPT_FORMATS:
+        raise ValueError(f"Unknown prompt format: {prompt_format}")
+    if log_format == "json" and prompt_format == "template":
+        raise ValueError(
+            "Prompts can only be logged as templates with the compact log"
+            " format."
+        )
     os.makedirs(directory, exist_ok=True)
 
     partial_game_state_file = f"{directory}/game_partial.json"
+    checkpoint_file = f"{directory}/{CHECKPOINT_FILE}"
     if state.error_message:
         game_file = partial_game_state_file
     else:
         game_file = f"{directory}/game_complete.json"
-        # Remove the partial game file if it exists
-        if os.path.exists(partial_game_state_file):
-            os.remove(partial_game_state_file)
-
-    log_file = f"{directory}/game_logs.json"
+        # Remove the partial game file and the checkpoint if they exist
+        for file in [partial_game_state_file, checkpoint_file]:
+            if os.path.exists(file):
+                os.remove(file)
 
     with open(game_file, "w") as file:
         json.dump(state.to_dict(), file, indent=4)
 
-    with open(log_file, "w") as file:
+    if log_format == "compact":
+        log_file, stale_file = COMPACT_LOG_FILE, LOG_FILE
+        _write_compact_logs(logs, f"{directory}/{log_file}", prompt_format)
+    elif log_format == "json":
+        log_file, stale_file = LOG_FILE, COMPACT_LOG_FILE
+        with open(f"{directory}/{log_file}", "w") as file:
+            deltas = _WorldstateDeltas()
+            json.dump(
+                [_log_data(log, prompt_format, deltas) for log in logs],
+                file,
+                indent=4,
+            )
+    else:
+        raise ValueError(f"Unknown log format: {log_format}")
+    # A resumed game may have been saved in the other format before.
+    if os.path.exists(f"{directory}/{stale_file}"):
+        os.remove(f"{directory}/{stale_file}")
+
+
+def _read_logs(directory: str) -> List[dict]:
+    """Reads the JSON data of the logs, preferring the compact file, which
+    `render_prompts` leaves next to a rendered `LOG_FILE`."""
+    if os.path.exists(f"{directory}/{COMPACT_LOG_FILE}"):
+        return _read_compact_logs(f"{directory}/{COMPACT_LOG_FILE}")
+    with open(f"{directory}/{LOG_FILE}", "r") as file:
+        return json.load(file)
+
+
+def render_prompts(directory: str):
+    """Writes the logs of a game to `LOG_FILE` with the prompts rendered, which
+    is what the viewer reads.
+
+    Compact logs are left as they are, next to the rendered copy. Logs that
+    already are a `LOG_FILE` can't be rendered without overwriting them.
+    """
+    if not os.path.exists(f"{directory}/{COMPACT_LOG_FILE}"):
+        templates = []
+        _map_prompts(_read_logs(directory), templates.append, templates=True)
+        if templates:
+            raise ValueError(
+                f"The prompts of {directory}/{LOG_FILE} are templates, which"
+                " can only be rendered for logs saved with"
+                " --log_format=compact."
+            )
+        return
+    _, logs = load_game(directory)
+    with open(f"{directory}/{LOG_FILE}", "w") as file:
         json.dump(to_dict(logs), file, indent=4)
+
+
+class _WorldstateDeltas:
+    """Stores the prompt sources of a game as changes to the previous source of
+    the same player.
+
+    A player's worldstate mostly repeats from one call to the next: only the
+    debate grows and the latest observations change. A source is stored as
+    the index of the player's previous source ("base"), the values that
+    changed ("worldstate"), the lists that kept a prefix of the previous ones
+    as [length of that prefix, rest of the list] ("lists") and the variables
+    that are gone ("removed"). Sources must be decoded in the order they were
+    encoded.
+    """
+
+    def __init__(self):
+        self.sources: List[dict] = []
+        self.last: dict = {}
+
+    def encode(self, source: dict) -> dict:
+        worldstate = source["worldstate"]
+        base_index = self.last.get(worldstate.get("name"))
+        self.last[worldstate.get("name")] = len(self.sources)
+        self.sources.append(source)
+        if base_index is None:
+            return source
+        base = self.sources[base_index]["worldstate"]
+        changed, lists = {}, {}
+        for key, value in worldstate.items():
+            old = base.get(key)
+            if key in base and old == value:
+                continue
+            if isinstance(value, list) and isinstance(old, list):
+                length = 0
+                for a, b in zip(old, value):
+                    if a != b:
+                        break
+                    length += 1
+                lists[key] = [length, value[length:]]
+            else:
+                changed[key] = value
+        delta = {
+            "template": source["template"],
+            "version": source["version"],
+            "base": base_index,
+            "worldstate": changed,
+        }
+        if lists:
+            delta["lists"] = lists
+        removed = [key for key in base if key not in worldstate]
+        if removed:
+            delta["removed"] = removed
+        return delta
+
+    def decode(self, stored: dict) -> dict:
+        if "base" not in stored:
+            self.sources.append(stored)
+            return stored
+        base = self.sources[stored["base"]]["worldstate"]
+        removed = stored.get("removed", ())
+        worldstate = {k: v for k, v in base.items() if k not in removed}
+        worldstate.update(stored["worldstate"])
+        for key, (length, rest) in stored.get("lists", {}).items():
+            worldstate[key] = base[key][:length] + rest
+        source = {
+            "template": stored["template"],
+            "version": stored["version"],
+            "worldstate": worldstate,
+        }
+        self.sources.append(source)
+        return source
+
+
+def _store_prompt_sources(o: Any, data: Any, deltas: _WorldstateDeltas):
+    """Replaces the prompts in `data`, the JSON data of `o`, with the template
+    and worldstate they were rendered from, where these are known."""
+    if isinstance(o, LmLog):
+        if o.prompt_source is not None:
+            data["prompt"] = deltas.encode(o.prompt_source)
+    elif isinstance(o, (list, tuple)):
+        for item, item_data in zip(o, data):
+            _store_prompt_sources(item, item_data, deltas)
+    elif isinstance(o, dict):
+        for item, item_data in zip(o.values(), data.values()):
+            _store_prompt_sources(item, item_data, deltas)
+    elif isinstance(data, dict):
+        for key, item_data in data.items():
+            _store_prompt_sources(getattr(o, key), item_data, deltas)
+
+
+def _log_data(
+    log: RoundLog, prompt_format: str, deltas: _WorldstateDeltas
+) -> dict:
+    data = to_dict(log)
+    if prompt_format == "template":
+        _store_prompt_sources(log, data, deltas)
+    return data
+
+
+def _common_prefix_length(a: str, b: str, at_least: int = 0) -> int:
+    """Returns the length of the common prefix of `a` and `b`, or -1 if it is
+    shorter than `at_least`."""
+    if a[:at_least] != b[:at_least]:
+        return -1
+    low, high = at_least, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+class _PromptTable:
+    """Stores prompts as the prefix they share with an earlier prompt.
+
+    Prompts repeat the rules, the player's state and observations and the
+    debate so far, so most of a prompt is usually the start of a recent one.
+    A prompt is encoded as [index of that prompt or -1, length of the shared
+    prefix, rest of the prompt]. Prompts must be decoded in the order they
+    were encoded.
+    """
+
+    def __init__(self):
+        self.prompts: List[str] = []
+
+    def encode(self, prompt: str) -> list:
+        best, best_length = -1, 0
+        start = max(0, len(self.prompts) - _PROMPT_WINDOW)
+        for index in range(len(self.prompts) - 1, start - 1, -1):
+            length = _common_prefix_length(
+                self.prompts[index], prompt, best_length + 1
+            )
+            if length > best_length:
+                best, best_length = index, length
+        self.prompts.append(prompt)
+        return [best, best_length, prompt[best_length:]]
+
+    def decode(self, encoded: list) -> str:
+        index, length, rest = encoded
+        prompt = self.prompts[index][:length] + rest if index >= 0 else rest
+        self.prompts.append(prompt)
+        return prompt
+
+
+def _map_prompts(data: Any, fn: Callable[[Any], Any], templates=False):
+    """Replaces the prompts of the LmLogs in `data` with `fn(prompt)`, in
+    order: the prompts stored as their template if `templates`, and the other
+    ones otherwise."""
+    if isinstance(data, dict):
+        if (
+            "prompt" in data
+            and "raw_resp" in data
+            and isinstance(data["prompt"], dict) == templates
+        ):
+            data["prompt"] = fn(data["prompt"])
+        for value in data.values():
+            _map_prompts(value, fn, templates)
+    elif isinstance(data, list):
+        for value in data:
+            _map_prompts(value, fn, templates)
+
+
+def _write_compact_logs(
+    logs: List[RoundLog], path: str, prompt_format: str = "text"
+):
+    """Writes the logs as gzipped JSON lines: a header, then one round per
+    line, with the prompts encoded by `_PromptTable`."""
+    prompts = _PromptTable()
+    deltas = _WorldstateDeltas()
+    with gzip.open(path, "wt", compresslevel=6) as file:
+        header = {"format": "compact", "version": _COMPACT_LOG_VERSION}
+        file.write(json.dumps(header) + "\n")
+        for log in logs:
+            data = _log_data(log, prompt_format, deltas)
+            _map_prompts(data, prompts.encode)
+            file.write(json.dumps(data, separators=(",", ":")) + "\n")
+
+
+def _read_compact_logs(path: str) -> List[dict]:
+    prompts = _PromptTable()
+    with gzip.open(path, "rt") as file:
+        header = json.loads(file.readline())
+        if header.get("version") != _COMPACT_LOG_VERSION:
+            raise ValueError(f"Unsupported log version in {path}: {header}")
+        logs = []
+        for line in file:
+            data = json.loads(line)
+            _map_prompts(data, prompts.decode)
+            logs.append(data)
+    return logs
+
+
+class EvalManifest:
+    """An append-only JSONL file listing the games of an eval.
+
+    A line is added when a game starts, with its session id, log directory,
+    models and seed, and another when it ends, with its winner or whether it
+    failed. Games running on different threads can share a manifest.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _append(self, record: dict):
+        line = json.dumps(record) + "\n"
+        with self._lock, open(self.path, "a") as file:
+            file.write(line)
+
+    def start(self, state: State, directory: str):
+        self._append(
+            {
+                "event": "start",
+                "session_id": state.session_id,
+                "log_directory": directory,
+                "villager_model": state.seer.model,
+                "werewolf_model": state.werewolves[0].model,
+                "seed": state.seed,
+                "time": time.time(),
+            }
+        )
+
+    def finish(self, state: State, directory: str):
+        self._append(
+            {
+                "event": "finish",
+                "session_id": state.session_id,
+                "log_directory": directory,
+                "winner": state.winner,
+                "failed": bool(state.error_message),
+                "time": time.time(),
+            }
+        )
+
+
+class CheckpointWriter:
+    """Appends every completed round of a game to a JSONL checkpoint.
+
+    The first line holds the session id and the initial players. Every
+    following line holds a completed round: the `Round`, its `RoundLog`, the
+    players as they were at the end of the round and the winner, if any. The
+    file is fsync'd after every round, so a crash loses at most the round in
+    progress.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.file = f"{directory}/{CHECKPOINT_FILE}"
+
+    def _append(self, records: List[dict]):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.file, "a") as file:
+            for record in records:
+                file.write(json.dumps(record) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    def write_round(self, state: State, log: RoundLog, round_num: int):
+        records = []
+        if not os.path.exists(self.file) or not os.path.getsize(self.file):
+            records.append(
+                {
+                    "type": "header",
+                    "session_id": state.session_id,
+                    "seed": state.seed,
+                    "seer": state.seer.name,
+                    "doctor": state.doctor.name,
+                    "villagers": [p.name for p in state.villagers],
+                    "werewolves": [p.name for p in state.werewolves],
+                }
+            )
+        records.append(
+            {
+                "type": "round",
+                "round_num": round_num,
+                "round": state.rounds[round_num].to_dict(),
+                "log": log.to_dict(),
+                "players": {
+                    name: player.to_dict()
+                    for name, player in state.players.items()
+                },
+                "winner": state.winner,
+            }
+        )
+        self._append(records)
+
+
+def load_checkpoint(directory: str) -> Tuple[State, List[RoundLog]]:
+    """Rebuilds a game from its checkpoint.
+
+    Args:
+      directory: where the game log is stored
+
+    Returns:
+      The state and logs of the game as of the last completed round.
+    """
+    header = None
+    rounds = {}
+    with open(f"{directory}/{CHECKPOINT_FILE}", "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break  # The last line was cut short by a crash.
+            if record["type"] == "header":
+                header = record
+            else:
+                # A resumed game may rewrite a round; the last write wins.
+                rounds[record["round_num"]] = record
+
+    if header is None or not rounds:
+        raise ValueError(f"No completed round found in {directory}.")
+
+    records = [rounds[i] for i in sorted(rounds)]
+    players = records[-1]["players"]
+    state = State.from_json(
+        {
+            "session_id": header["session_id"],
+            "seed": header.get("seed"),
+            "seer": players[header["seer"]],
+            "doctor": players[header["doctor"]],
+            "villagers": [players[name] for name in header["villagers"]],
+            "werewolves": [players[name] for name in header["werewolves"]],
+            "rounds": [record["round"] for record in records],
+            "winner": records[-1]["winner"],
+        }
+    )
+    logs = [RoundLog.from_json(record["log"]) for record in records]
+    return (state, logs)
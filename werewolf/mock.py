@@ -0,0 +1,334 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An offline model backend for load and regression benchmarking.
+
+The backend is selected with a model name starting with `mock`, followed by
+options separated by colons:
+
+    mock                                  instant, deterministic responses
+    mock:random                           responses are not reproducible
+    mock:latency=200ms                    every call takes 200ms
+    mock:latency=200ms:jitter=50ms:dist=normal
+    mock:error_rate=0.05:invalid_rate=0.1:seed=7
+    mock:latency=1s:concurrency=16:rpm=600
+
+Options:
+  latency: mean latency of a call, e.g. `200ms` or `0.2s`. Bare numbers are
+    milliseconds.
+  jitter: spread of the latency. Its meaning depends on `dist`.
+  dist: `fixed` (default), `uniform` (latency +/- jitter), `normal` (jitter is
+    the standard deviation) or `exponential` (jitter is ignored).
+  error_rate: probability that a call raises `MockError`.
+  invalid_rate: probability that a call returns a response that can't be used,
+    either malformed JSON or a choice that isn't one of the options.
+  seed: changes the responses of deterministic runs.
+  random: draws from a fresh random source instead of the prompt.
+  rpm: requests per minute above which calls are throttled, i.e. raise
+    `MockRateLimitError` with a `retry_after`.
+  concurrency: calls in flight above which calls are throttled.
+
+Unless `random` is set, the response to a prompt is a function of the seed,
+the prompt and how many times that prompt was sent before, so games are
+reproducible regardless of thread scheduling.
+
+The backend also emulates provider-side prompt caching: when a call's
+`cache_prefix` was already sent, its tokens are counted as cached in
+`stats()` and in the usage of the call. Tokens are approximated as 4
+characters.
+"""
+
+import asyncio
+import collections
+import dataclasses
+import functools
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+CHARS_PER_TOKEN = 4
+# Number of distinct prefixes the emulated prompt cache remembers.
+PREFIX_CACHE_SIZE = 4096
+
+CHOICE_KEYS = ("vote", "remove", "investigate", "protect")
+BID_OPTIONS = ("0", "1", "2", "3", "4")
+_WORDS = (
+    "I think we should look closely at who has been quiet and who keeps"
+    " changing their story this round"
+).split()
+
+
+class MockError(RuntimeError):
+    """A simulated provider failure."""
+
+
+class MockRateLimitError(MockError):
+    """A simulated HTTP 429 response."""
+
+    status_code = 429
+
+    def __init__(self, retry_after: Optional[float] = None):
+        super().__init__("Simulated rate limit.")
+        self.retry_after = retry_after
+
+
+@dataclasses.dataclass(frozen=True)
+class MockConfig:
+    latency: float = 0.0
+    jitter: float = 0.0
+    dist: str = "fixed"
+    error_rate: float = 0.0
+    invalid_rate: float = 0.0
+    seed: int = 0
+    random: bool = False
+    rpm: int = 0
+    concurrency: int = 0
+
+
+def is_mock(model: str) -> bool:
+    return model == "mock" or model.startswith("mock:")
+
+
+def _parse_duration(value: str) -> float:
+    """Parses `200ms`, `0.2s` or `200` (milliseconds) into seconds."""
+    if value.endswith("ms"):
+        return float(value[:-2]) / 1000
+    if value.endswith("s"):
+        return float(value[:-1])
+    return float(value) / 1000
+
+
+@functools.lru_cache(maxsize=None)
+def parse_model(model: str) -> MockConfig:
+    """Parses the options of a `mock:...` model name."""
+    if not is_mock(model):
+        raise ValueError(f"{model} is not a mock model.")
+
+    options = {}
+    for option in model.split(":")[1:]:
+        if not option:
+            continue
+        key, _, value = option.partition("=")
+        if key in ("latency", "jitter"):
+            options[key] = _parse_duration(value)
+        elif key in ("error_rate", "invalid_rate"):
+            options[key] = float(value)
+        elif key in ("seed", "rpm", "concurrency"):
+            options[key] = int(value)
+        elif key == "dist":
+            if value not in ("fixed", "uniform", "normal", "exponential"):
+                raise ValueError(f"Unknown latency distribution: {value}")
+            options[key] = value
+        elif key == "random":
+            options[key] = True
+        else:
+            raise ValueError(f"Unknown mock option: {option}")
+    return MockConfig(**options)
+
+
+_LOCK = threading.Lock()
+_PROMPT_CALLS: collections.Counter = collections.Counter()
+_STATS: collections.Counter = collections.Counter()
+_PREFIXES: collections.OrderedDict = collections.OrderedDict()
+_IN_FLIGHT: collections.Counter = collections.Counter()
+_REQUEST_TIMES: Dict[str, collections.deque] = collections.defaultdict(
+    collections.deque
+)
+
+
+def stats() -> Dict[str, float]:
+    """Returns counters of the calls served by the mock backend."""
+    with _LOCK:
+        return dict(_STATS)
+
+
+def reset():
+    """Resets the counters and the deterministic call history."""
+    with _LOCK:
+        _PROMPT_CALLS.clear()
+        _STATS.clear()
+        _PREFIXES.clear()
+        _REQUEST_TIMES.clear()
+
+
+def _rng(config: MockConfig, prompt: str) -> random.Random:
+    if config.random:
+        return random.Random()
+    key = hashlib.sha256(prompt.encode()).hexdigest()
+    with _LOCK:
+        attempt = _PROMPT_CALLS[key]
+        _PROMPT_CALLS[key] += 1
+    return random.Random(f"{config.seed}:{key}:{attempt}")
+
+
+def _latency(config: MockConfig, rng: random.Random) -> float:
+    if config.dist == "uniform":
+        latency = rng.uniform(
+            config.latency - config.jitter, config.latency + config.jitter
+        )
+    elif config.dist == "normal":
+        latency = rng.gauss(config.latency, config.jitter)
+    elif config.dist == "exponential":
+        latency = rng.expovariate(1 / config.latency) if config.latency else 0
+    else:
+        latency = config.latency
+    return max(0.0, latency)
+
+
+def _options(prompt: str) -> list[str]:
+    matches = re.findall(r"Choose from: (.*)", prompt)
+    if not matches:
+        return []
+    return [o.strip() for o in matches[-1].split(",") if o.strip()]
+
+
+def _sentence(rng: random.Random) -> str:
+    return " ".join(rng.sample(_WORDS, 8)).capitalize() + "."
+
+
+def _response(
+    config: MockConfig,
+    rng: random.Random,
+    prompt: str,
+    response_schema: Dict[str, Any],
+) -> str:
+    """Returns a JSON response matching the schema, or an invalid one."""
+    invalid = rng.random() < config.invalid_rate
+    if invalid and rng.random() < 0.5:
+        return "I'm not sure what to say."
+
+    result = {}
+    for key in response_schema.get("properties", {}):
+        if key in CHOICE_KEYS:
+            options = _options(prompt)
+            result[key] = (
+                "Nobody" if invalid or not options else rng.choice(options)
+            )
+        elif key == "bid":
+            result[key] = "5" if invalid else rng.choice(BID_OPTIONS)
+        else:
+            result[key] = _sentence(rng)
+    return json.dumps(result)
+
+
+def _admit(model: str, config: MockConfig):
+    """Starts a call, unless it exceeds the simulated rate limits."""
+    now = time.monotonic()
+    with _LOCK:
+        if config.rpm:
+            times = _REQUEST_TIMES[model]
+            while times and now - times[0] >= 60:
+                times.popleft()
+            if len(times) >= config.rpm:
+                _STATS["throttled"] += 1
+                raise MockRateLimitError(retry_after=60 - (now - times[0]))
+            times.append(now)
+        if config.concurrency and _IN_FLIGHT[model] >= config.concurrency:
+            _STATS["throttled"] += 1
+            raise MockRateLimitError()
+        _IN_FLIGHT[model] += 1
+
+
+def _done(model: str):
+    with _LOCK:
+        _IN_FLIGHT[model] -= 1
+
+
+def _prepare(model: str, prompt: str, response_schema: Dict[str, Any]):
+    config = parse_model(model)
+    rng = _rng(config, prompt)
+    latency = _latency(config, rng)
+    error = rng.random() < config.error_rate
+    response = _response(config, rng, prompt, response_schema)
+    return latency, error, response
+
+
+def _count_prompt(prompt: str, cache_prefix: str) -> int:
+    """Counts the prompt tokens, and the ones an LRU prefix cache would hit.
+
+    Returns the number of cached tokens.
+    """
+    key = hashlib.sha256(cache_prefix.encode()).hexdigest()
+    with _LOCK:
+        _STATS["prompt_tokens"] += len(prompt) // CHARS_PER_TOKEN
+        if not cache_prefix:
+            return 0
+        if key in _PREFIXES:
+            _PREFIXES.move_to_end(key)
+            cached = len(cache_prefix) // CHARS_PER_TOKEN
+            _STATS["cached_prompt_tokens"] += cached
+            return cached
+        _PREFIXES[key] = True
+        if len(_PREFIXES) > PREFIX_CACHE_SIZE:
+            _PREFIXES.popitem(last=False)
+        return 0
+
+
+def _usage(prompt: str, response: str, cached: int) -> Dict[str, int]:
+    return {
+        "input_tokens": len(prompt) // CHARS_PER_TOKEN,
+        "output_tokens": len(response) // CHARS_PER_TOKEN,
+        "cached_input_tokens": cached,
+    }
+
+
+def _finish(latency: float, error: bool, response: str) -> str:
+    with _LOCK:
+        _STATS["calls"] += 1
+        _STATS["latency_s"] += latency
+        if error:
+            _STATS["errors"] += 1
+    if error:
+        raise MockError("Simulated model failure.")
+    return response
+
+
+def generate(
+    model: str,
+    prompt: str,
+    response_schema: Dict[str, Any],
+    cache_prefix: str = "",
+    **kwargs,
+) -> Tuple[str, Dict[str, int]]:
+    _admit(model, parse_model(model))
+    try:
+        cached = _count_prompt(prompt, cache_prefix)
+        latency, error, response = _prepare(model, prompt, response_schema)
+        time.sleep(latency)
+        response = _finish(latency, error, response)
+    finally:
+        _done(model)
+    return response, _usage(prompt, response, cached)
+
+
+async def agenerate(
+    model: str,
+    prompt: str,
+    response_schema: Dict[str, Any],
+    cache_prefix: str = "",
+    **kwargs,
+) -> Tuple[str, Dict[str, int]]:
+    _admit(model, parse_model(model))
+    try:
+        cached = _count_prompt(prompt, cache_prefix)
+        latency, error, response = _prepare(model, prompt, response_schema)
+        await asyncio.sleep(latency)
+        response = _finish(latency, error, response)
+    finally:
+        _done(model)
+    return response, _usage(prompt, response, cached)
@@ -15,12 +15,14 @@
 import enum
 import json
 import random
-from typing import Any, Dict, List, Optional, Tuple, Union
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
-from werewolf.lm import LmLog, generate
+from werewolf.lm import LmLog, UsageTotals, agenerate, generate
 from werewolf.prompts import ACTION_PROMPTS_AND_SCHEMAS
 from werewolf.utils import Deserializable
 from werewolf.config import  MAX_DEBATE_TURNS, NUM_PLAYERS
+from werewolf.config import CACHE_PROMPT_PREFIX
 
 # Role names
 VILLAGER = "Villager"
@@ -55,6 +57,50 @@ def group_and_format_observations(observations):
   return formatted_obs
 
 
+class ObservationIndex:
+  """Incrementally groups and formats a player's observations by round.
+
+  The observations are parsed once into (round, text) records and each round's
+  block is rendered once, when the round gets a new observation. The output is
+  the same as `group_and_format_observations`.
+
+  The observations list is expected to only grow; if it is replaced or shrinks
+  the index is rebuilt from scratch.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._source: Optional[List[str]] = None
+    self._count = 0
+    self._records: Dict[int, List[str]] = {}
+    self._blocks: Dict[int, str] = {}
+
+  def format(self, observations: List[str]) -> List[str]:
+    with self._lock:
+      if observations is not self._source or len(observations) < self._count:
+        self._source = observations
+        self._count = 0
+        self._records = {}
+        self._blocks = {}
+
+      changed = set()
+      for obs in observations[self._count :]:
+        round_num = int(obs.split(":", 1)[0].split()[1])
+        obs_text = obs.split(":", 1)[1].strip().replace('"', "")
+        self._records.setdefault(round_num, []).append(obs_text)
+        changed.add(round_num)
+      self._count = len(observations)
+
+      for round_num in changed:
+        formatted_round = f"Round {round_num}:\n"
+        formatted_round += "\n".join(
+            f"   - {obs}" for obs in self._records[round_num]
+        )
+        self._blocks[round_num] = formatted_round
+
+      return [self._blocks[round_num] for round_num in sorted(self._blocks)]
+
+
 # JSON serializer that works for nested classes
 class JsonEncoder(json.JSONEncoder):
 
@@ -63,10 +109,47 @@ class JsonEncoder(json.JSONEncoder):
       return o.value
     if isinstance(o, set):
       return list(o)
-    return o.__dict__
+    # Private attributes are caches and runtime helpers, not game data.
+    return {k: v for k, v in o.__dict__.items() if not k.startswith("_")}
+
+_ENCODER = JsonEncoder()
+
+
+def _json_key(key: Any) -> str:
+  """Converts a dict key the way `json` does, e.g. True to "true"."""
+  if isinstance(key, str):
+    return str.__str__(key)
+  return next(iter(json.loads(json.dumps({key: None}))))
+
 
 def to_dict(o: Any) -> Union[Dict[str, Any], List[Any], Any]:
-  return json.loads(JsonEncoder().encode(o))
+  """Converts game objects to JSON data, walking them directly.
+
+  The result is the same as encoding `o` with `JsonEncoder` and decoding it
+  again, but doesn't build the JSON string in between.
+  """
+  cls = type(o)
+  if cls is str or cls is int or cls is float or cls is bool or o is None:
+    return o
+  if cls is dict:
+    return {
+        k if type(k) is str else _json_key(k): to_dict(v) for k, v in o.items()
+    }
+  if cls is list or cls is tuple:
+    return [to_dict(v) for v in o]
+  # Checked in the same order as `json.JSONEncoder`, so that e.g. an IntEnum
+  # is an int rather than an enum.
+  if isinstance(o, str):
+    return str.__str__(o)
+  if isinstance(o, int):
+    return int(o)
+  if isinstance(o, float):
+    return float(o)
+  if isinstance(o, (list, tuple)):
+    return [to_dict(v) for v in o]
+  if isinstance(o, dict):
+    return {_json_key(k): to_dict(v) for k, v in o.items()}
+  return to_dict(_ENCODER.default(o))
 
 class GameView:
   """Represents the state of the game for each player."""
@@ -124,6 +207,16 @@ class Player(Deserializable):
     self.observations: List[str] = []
     self.bidding_rationale = ""
     self.gamestate: Optional[GameView] = None
+    self._observation_index = ObservationIndex()
+    self._players_order_key = None
+    self._players_order: List[str] = []
+    self._rng = random.Random()
+    self._seed: Any = None
+
+  def set_seed(self, seed: Any):
+    """Seeds the random choices of the player, e.g. the order of options."""
+    self._seed = seed
+    self._rng.seed(seed)
 
   def initialize_game_view(
       self, round_number, current_players, other_wolf=None
@@ -145,18 +238,39 @@ class Player(Deserializable):
     """Adds the current game announcement to the player's observations."""
     self._add_observation(f"Moderator Announcement: {announcement}")
 
-  def _get_game_state(self) -> Dict[str, Any]:
+  def _remaining_players(self, action: str) -> List[str]:
+    """Returns the remaining players in a random order.
+
+    The order of every prompt is drawn from the player's seed, the round, the
+    debate turn and the action, so that discarded prompts, e.g. speculative
+    debate turns, don't change the order in the next ones. With
+    CACHE_PROMPT_PREFIX, the order is kept until the round or the remaining
+    players change instead, so the game state part of the player's prompts
+    stays identical within a round and can be cached by the model provider.
+    """
+    key = (self.gamestate.round_number, tuple(self.gamestate.current_players))
+    rng = self._rng
+    if not CACHE_PROMPT_PREFIX:
+      key += (len(self.gamestate.debate), action)
+      rng = random.Random(f"{self._seed}:{key}")
+    if key != self._players_order_key:
+      remaining_players = [
+          f"{player} (You)" if player == self.name else player
+          for player in self.gamestate.current_players
+      ]
+      rng.shuffle(remaining_players)
+      self._players_order_key = key
+      self._players_order = remaining_players
+    return list(self._players_order)
+
+  def _get_game_state(self, action: str) -> Dict[str, Any]:
     """Gets the current game state from the player's perspective."""
     if not self.gamestate:
       raise ValueError(
           "GameView not initialized. Call initialize_game_view() first."
       )
 
-    remaining_players = [
-        f"{player} (You)" if player == self.name else player
-        for player in self.gamestate.current_players
-    ]
-    random.shuffle(remaining_players)
+    remaining_players = self._remaining_players(action)
     formatted_debate = [
         f"{author} (You): {dialogue}"
         if author == self.name
@@ -164,7 +278,7 @@ class Player(Deserializable):
         for author, dialogue in self.gamestate.debate
     ]
 
-    formatted_observations = group_and_format_observations(self.observations)
+    formatted_observations = self._observation_index.format(self.observations)
 
     return {
         "name": self.name,
@@ -180,13 +294,13 @@ class Player(Deserializable):
         "num_villagers": NUM_PLAYERS - 4, 
     }
 
-  def _generate_action(
+  def _action_request(
       self,
       action: str,
       options: Optional[List[str]] = None,
-  ) -> tuple[Any | None, LmLog]:
-    """Helper function to generate player actions."""
-    game_state = self._get_game_state()
+  ) -> Dict[str, Any]:
+    """Builds the arguments of the LLM request for the given action."""
+    game_state = self._get_game_state(action)
     if options:
       game_state["options"] = (", ").join(options)
     prompt_template, response_schema = ACTION_PROMPTS_AND_SCHEMAS[action]
@@ -200,18 +314,33 @@ class Player(Deserializable):
     # Set temperature based on allowed_values
     temperature = 0.5 if allowed_values else 1.0
 
-    return generate(
-        prompt_template,
-        response_schema,
-        game_state,
+    return dict(
+        prompt_template=prompt_template,
+        response_schema=response_schema,
+        worldstate=game_state,
         model=self.model,
         temperature=temperature,
         allowed_values=allowed_values,
         result_key=result_key,
     )
 
-  def vote(self) -> tuple[str | None, LmLog]:
-    """Vote for a player."""
+  def _generate_action(
+      self,
+      action: str,
+      options: Optional[List[str]] = None,
+  ) -> tuple[Any | None, LmLog]:
+    """Helper function to generate player actions."""
+    return generate(**self._action_request(action, options))
+
+  async def _agenerate_action(
+      self,
+      action: str,
+      options: Optional[List[str]] = None,
+  ) -> tuple[Any | None, LmLog]:
+    """Async version of `_generate_action`."""
+    return await agenerate(**self._action_request(action, options))
+
+  def _vote_options(self) -> List[str]:
     if not self.gamestate:
       raise ValueError(
           "GameView not initialized. Call initialize_game_view() first."
@@ -221,21 +350,57 @@ class Player(Deserializable):
         for player in self.gamestate.current_players
         if player != self.name
     ]
-    random.shuffle(options)
-    vote, log = self._generate_action("vote", options)
+    self._rng.shuffle(options)
+    return options
+
+  def _record_vote(self, vote: str | None):
     if vote is not None and len(self.gamestate.debate) == MAX_DEBATE_TURNS:
       self._add_observation(
           f"After the debate, I voted to remove {vote} from the game."
       )
+
+  def vote_request(self) -> Dict[str, Any]:
+    """Builds the LLM request of a vote on the current game state."""
+    return self._action_request("vote", self._vote_options())
+
+  def vote(
+      self, request: Optional[Dict[str, Any]] = None
+  ) -> tuple[str | None, LmLog]:
+    """Vote for a player.
+
+    Args:
+      request: A request from `vote_request`, to vote on the game state at the
+        time it was built rather than the current one.
+    """
+    vote, log = generate(**(request or self.vote_request()))
+    self._record_vote(vote)
     return vote, log
 
-  def bid(self) -> tuple[int | None, LmLog]:
-    """Place a bid."""
-    bid, log = self._generate_action("bid", options=["0", "1", "2", "3", "4"])
+  async def avote(
+      self, request: Optional[Dict[str, Any]] = None
+  ) -> tuple[str | None, LmLog]:
+    """Async version of `vote`."""
+    vote, log = await agenerate(**(request or self.vote_request()))
+    self._record_vote(vote)
+    return vote, log
+
+  def _record_bid(self, bid: str | None, log: LmLog) -> int | None:
     if bid is not None:
       bid = int(bid)
       self.bidding_rationale = log.result.get("reasoning", "")
-    return bid, log
+    return bid
+
+  def bid(self) -> tuple[int | None, LmLog]:
+    """Place a bid."""
+    bid, log = self._generate_action("bid", options=["0", "1", "2", "3", "4"])
+    return self._record_bid(bid, log), log
+
+  async def abid(self) -> tuple[int | None, LmLog]:
+    """Async version of `bid`."""
+    bid, log = await self._agenerate_action(
+        "bid", options=["0", "1", "2", "3", "4"]
+    )
+    return self._record_bid(bid, log), log
 
   def debate(self) -> tuple[str | None, LmLog]:
     """Engage in the debate."""
@@ -245,16 +410,32 @@ class Player(Deserializable):
       return say, log
     return result, log
 
-  def summarize(self) -> tuple[str | None, LmLog]:
-    """Summarize the game state."""
-    result, log = self._generate_action("summarize", [])
+  async def adebate(self) -> tuple[str | None, LmLog]:
+    """Async version of `debate`."""
+    result, log = await self._agenerate_action("debate", [])
+    if result is not None:
+      say = result.get("say", None)
+      return say, log
+    return result, log
+
+  def _record_summary(self, result: Dict[str, Any] | None) -> str | None:
     if result is not None:
       summary = result.get("summary", None)
       if summary is not None:
         summary = summary.strip('"')
         self._add_observation(f"Summary: {summary}")
-      return summary, log
-    return result, log
+      return summary
+    return result
+
+  def summarize(self) -> tuple[str | None, LmLog]:
+    """Summarize the game state."""
+    result, log = self._generate_action("summarize", [])
+    return self._record_summary(result), log
+
+  async def asummarize(self) -> tuple[str | None, LmLog]:
+    """Async version of `summarize`."""
+    result, log = await self._agenerate_action("summarize", [])
+    return self._record_summary(result), log
 
   def to_dict(self) -> Any:
     return to_dict(self)
@@ -308,14 +489,13 @@ class Werewolf(Player):
         name=name, role=WEREWOLF, model=model, personality=personality
     )
 
-  def _get_game_state(self, **kwargs) -> Dict[str, Any]:
+  def _get_game_state(self, action: str) -> Dict[str, Any]:
     """Gets the current game state, including werewolf-specific context."""
-    state = super()._get_game_state(**kwargs)
+    state = super()._get_game_state(action)
     state["werewolf_context"] = self._get_werewolf_context()
     return state
 
-  def eliminate(self) -> tuple[str | None, "LmLog"]:
-    """Choose a player to eliminate."""
+  def _eliminate_options(self) -> List[str]:
     if not self.gamestate:
       raise ValueError(
           "GameView not initialized. Call initialize_game_view() first."
@@ -326,10 +506,18 @@ class Werewolf(Player):
         for player in self.gamestate.current_players
         if player != self.name and player != self.gamestate.other_wolf
     ]
-    random.shuffle(options)
-    eliminate, log = self._generate_action("remove", options)
+    self._rng.shuffle(options)
+    return options
+
+  def eliminate(self) -> tuple[str | None, "LmLog"]:
+    """Choose a player to eliminate."""
+    eliminate, log = self._generate_action("remove", self._eliminate_options())
     return eliminate, log
 
+  async def aeliminate(self) -> tuple[str | None, "LmLog"]:
+    """Async version of `eliminate`."""
+    return await self._agenerate_action("remove", self._eliminate_options())
+
   def _get_werewolf_context(self):
     if not self.gamestate:
       raise ValueError(
@@ -369,8 +557,7 @@ class Seer(Player):
     super().__init__(name=name, role=SEER, model=model, personality=personality)
     self.previously_unmasked: Dict[str, str] = {}
 
-  def unmask(self) -> tuple[str | None, LmLog]:
-    """Choose a player to unmask."""
+  def _unmask_options(self) -> List[str]:
     if not self.gamestate:
       raise ValueError(
           "GameView not initialized. Call initialize_game_view() first."
@@ -381,8 +568,16 @@ class Seer(Player):
         for player in self.gamestate.current_players
         if player != self.name and player not in self.previously_unmasked.keys()
     ]
-    random.shuffle(options)
-    return self._generate_action("investigate", options)
+    self._rng.shuffle(options)
+    return options
+
+  def unmask(self) -> tuple[str | None, LmLog]:
+    """Choose a player to unmask."""
+    return self._generate_action("investigate", self._unmask_options())
+
+  async def aunmask(self) -> tuple[str | None, LmLog]:
+    """Async version of `unmask`."""
+    return await self._agenerate_action("investigate", self._unmask_options())
 
   def reveal_and_update(self, player, role):
     self._add_observation(
@@ -415,18 +610,32 @@ class Doctor(Player):
         name=name, role=DOCTOR, model=model, personality=personality
     )
 
-  def save(self) -> tuple[str | None, LmLog]:
-    """Choose a player to protect."""
+  def _save_options(self) -> List[str]:
     if not self.gamestate:
       raise ValueError(
           "GameView not initialized. Call initialize_game_view() first."
       )
 
     options = list(self.gamestate.current_players)
-    random.shuffle(options)
-    protected, log = self._generate_action("protect", options)
+    self._rng.shuffle(options)
+    return options
+
+  def _record_save(self, protected: str | None):
     if protected is not None:
       self._add_observation(f"During the night, I chose to protect {protected}")
+
+  def save(self) -> tuple[str | None, LmLog]:
+    """Choose a player to protect."""
+    protected, log = self._generate_action("protect", self._save_options())
+    self._record_save(protected)
+    return protected, log
+
+  async def asave(self) -> tuple[str | None, LmLog]:
+    """Async version of `save`."""
+    protected, log = await self._agenerate_action(
+        "protect", self._save_options()
+    )
+    self._record_save(protected)
     return protected, log
 
   @classmethod
@@ -503,6 +712,8 @@ class State(Deserializable):
     error_message: Contains an error message if the game failed during
       execution.
     winner: Villager or Werewolf
+    seed: Seed of the random choices made during the game, if any. Together
+      with cached model responses it lets the game be replayed.
 
   Methods:
     to_dict: Returns a dictionary representation of the game.
@@ -515,6 +726,7 @@ class State(Deserializable):
       doctor: Doctor,
       villagers: List[Villager],
       werewolves: List[Werewolf],
+      seed: Optional[int] = None,
   ):
     self.session_id: str = session_id
     self.seer: Seer = seer
@@ -530,6 +742,7 @@ class State(Deserializable):
     self.rounds: List[Round] = []
     self.error_message: str = ""
     self.winner: str = ""
+    self.seed: Optional[int] = seed
 
   def to_dict(self):
     return to_dict(self)
@@ -557,6 +770,7 @@ class State(Deserializable):
         doctor,
         villagers,
         werewolves,
+        seed=data.get("seed"),
     )
     rounds = []
     for r in data.get("rounds", []):
@@ -656,3 +870,75 @@ class RoundLog(Deserializable):
       o.summaries.append((player[0], LmLog.from_json(player[1])))
 
     return o
+
+  def model_calls(self) -> Iterator[Tuple[str, Optional[str], LmLog]]:
+    """Yields the phase, the player and the log of every model call.
+
+    The phases are named after the attributes of the RoundLog. The player of
+    the night actions isn't recorded, so it is None.
+    """
+    for phase in ["eliminate", "investigate", "protect"]:
+      log = getattr(self, phase)
+      if log:
+        yield phase, None, log
+    for turn in self.bid:
+      for player, log in turn:
+        yield "bid", player, log
+    for player, log in self.debate:
+      yield "debate", player, log
+    for turn in self.votes:
+      for vote in turn:
+        yield "votes", vote.player, vote.log
+    for player, log in self.summaries:
+      yield "summaries", player, log
+
+  def usage_by_phase(self) -> Dict[str, UsageTotals]:
+    """Totals the latency, tokens and retries of the round by phase."""
+    usage = {}
+    for phase, _, log in self.model_calls():
+      usage.setdefault(phase, UsageTotals()).add(log)
+    return usage
+
+  def usage_by_player(self, seer: str, doctor: str) -> Dict[str, UsageTotals]:
+    """Totals the latency, tokens and retries of the round by player.
+
+    Werewolves eliminate as a team, so those calls are counted under
+    `WEREWOLF` rather than a player.
+    """
+    night_players = {
+        "eliminate": WEREWOLF,
+        "investigate": seer,
+        "protect": doctor,
+    }
+    usage = {}
+    for phase, player, log in self.model_calls():
+      usage.setdefault(player or night_players[phase], UsageTotals()).add(log)
+    return usage
+
+
+def _merge_usage(
+    round_usage: Iterator[Dict[str, UsageTotals]],
+) -> Dict[str, UsageTotals]:
+  usage = {}
+  for totals_by_key in round_usage:
+    for key, totals in totals_by_key.items():
+      usage.setdefault(key, UsageTotals()).merge(totals)
+  return usage
+
+
+def usage_by_phase(logs: List[RoundLog]) -> Dict[str, UsageTotals]:
+  """Totals the latency, tokens and retries of a game by phase."""
+  return _merge_usage(log.usage_by_phase() for log in logs)
+
+
+def usage_by_player(
+    logs: List[RoundLog], seer: str, doctor: str
+) -> Dict[str, UsageTotals]:
+  """Totals the latency, tokens and retries of a game by player.
+
+  Args:
+    logs: The logs of the game's rounds.
+    seer: Name of the Seer, whose investigations are counted under them.
+    doctor: Name of the Doctor, whose protections are counted under them.
+  """
+  return _merge_usage(log.usage_by_player(seer, doctor) for log in logs)
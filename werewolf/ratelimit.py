@@ -0,0 +1,364 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Client-side rate limiting and concurrency control per provider.
+
+Every request to a provider goes through its `ProviderLimiter`, which is shared
+by all the games in the process:
+
+  - Token buckets cap the requests and tokens per minute, when limits are set
+    with `configure`, e.g. from `--rate_limits=openai:rpm=500:tpm=300000`.
+  - An AIMD controller caps the requests in flight. The cap grows by about one
+    request per cap's worth of successful requests, and halves when the
+    provider throttles (HTTP 429).
+  - A `Retry-After` sent with a 429 pauses every request to the provider.
+
+`stats()` reports the requests throttled and the time spent waiting.
+"""
+
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import random
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+DEFAULT_MAX_CONCURRENCY = 256
+# Tokens are reserved before a request is sent and corrected once its usage is
+# known. The estimate assumes 4 characters per token and a short response.
+CHARS_PER_TOKEN = 4
+ESTIMATED_OUTPUT_TOKENS = 256
+BACKOFF_BASE_S = 1.0
+BACKOFF_MAX_S = 60.0
+
+
+@dataclasses.dataclass(frozen=True)
+class Limits:
+    """Limits of a provider. 0 means no limit."""
+
+    requests_per_minute: float = 0
+    tokens_per_minute: float = 0
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+
+
+def parse_limits(spec: str) -> Tuple[str, Limits]:
+    """Parses `provider:rpm=500:tpm=300000:concurrency=32`."""
+    provider, *options = spec.split(":")
+    limits = {}
+    for option in options:
+        key, _, value = option.partition("=")
+        if key == "rpm":
+            limits["requests_per_minute"] = float(value)
+        elif key == "tpm":
+            limits["tokens_per_minute"] = float(value)
+        elif key == "concurrency":
+            limits["max_concurrency"] = int(value)
+        else:
+            raise ValueError(f"Unknown rate limit option: {option}")
+    return provider, Limits(**limits)
+
+
+def estimate_tokens(prompt: str) -> int:
+    return len(prompt) // CHARS_PER_TOKEN + ESTIMATED_OUTPUT_TOKENS
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    """Whether the error is a provider's HTTP 429 response."""
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    return status == 429
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """Returns the seconds to wait requested by a throttled response."""
+    value = getattr(error, "retry_after", None)
+    if value is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+        if headers is None:
+            return None
+        value = headers.get("retry-after-ms")
+        if value is not None:
+            value = float(value) / 1000
+        else:
+            value = headers.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None  # An HTTP date, which the providers don't send.
+
+
+class TokenBucket:
+    """A token bucket refilled continuously up to one minute of tokens.
+
+    `reserve` always succeeds, possibly leaving the bucket in debt, and returns
+    how long the caller must wait for the debt to be repaid. This works the
+    same for threads and coroutines, which wait with their own sleep.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self._tokens = per_minute
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate)
+
+    def adjust(self, amount: float):
+        """Takes `amount` more tokens, or gives them back if negative."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens - amount)
+
+
+class ConcurrencyController:
+    """Caps the requests in flight with additive increase and multiplicative
+    decrease (AIMD).
+
+    Only requests sent after the last decrease can decrease the cap again, so
+    a burst of throttled requests halves it once.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._async_waiters = []
+
+    def _try_acquire(self) -> bool:
+        if self.in_flight < max(1, int(self.limit)):
+            self.in_flight += 1
+            return True
+        return False
+
+    def acquire(self):
+        with self._cond:
+            while not self._try_acquire():
+                self._cond.wait()
+
+    async def aacquire(self):
+        while True:
+            with self._cond:
+                if self._try_acquire():
+                    return
+                loop = asyncio.get_running_loop()
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            await waiter
+
+    def release(self, started: float, throttled: bool):
+        with self._cond:
+            self.in_flight -= 1
+            if not throttled:
+                self.limit = min(
+                    self.max_concurrency, self.limit + 1 / self.limit
+                )
+            elif started >= self._last_decrease:
+                self.limit = max(1.0, self.limit / 2)
+                self._last_decrease = time.monotonic()
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+@dataclasses.dataclass
+class Request:
+    """A request admitted by a `ProviderLimiter`."""
+
+    limiter: "ProviderLimiter"
+    started: float
+    tokens: int
+
+    def record_tokens(self, tokens: int):
+        """Corrects the token estimate with the usage of the response."""
+        if self.limiter.tokens is not None and tokens:
+            self.limiter.tokens.adjust(tokens - self.tokens)
+            self.tokens = tokens
+
+
+class ProviderLimiter:
+    """The rate limits and concurrency cap of one provider."""
+
+    def __init__(self, provider: str, limits: Limits):
+        self.provider = provider
+        self.limits = limits
+        self.requests = (
+            TokenBucket(limits.requests_per_minute)
+            if limits.requests_per_minute
+            else None
+        )
+        self.tokens = (
+            TokenBucket(limits.tokens_per_minute)
+            if limits.tokens_per_minute
+            else None
+        )
+        self.concurrency = ConcurrencyController(limits.max_concurrency)
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def _reserve(self, tokens: int) -> float:
+        """Reserves a request and its tokens; returns how long to wait."""
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(tokens))
+        with self._lock:
+            return max(wait, self._paused_until - time.monotonic())
+
+    def count(self, key: str, value: float = 1):
+        """Adds `value` to one of the stats."""
+        with self._lock:
+            self._stats[key] += value
+
+    def acquire(self, tokens: int) -> Request:
+        start = time.monotonic()
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        self.concurrency.acquire()
+        started = time.monotonic()
+        self.count("requests")
+        self.count("throttle_wait_s", started - start)
+        return Request(self, started=started, tokens=tokens)
+
+    async def aacquire(self, tokens: int) -> Request:
+        start = time.monotonic()
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self.concurrency.aacquire()
+        started = time.monotonic()
+        self.count("requests")
+        self.count("throttle_wait_s", started - start)
+        return Request(self, started=started, tokens=tokens)
+
+    def release(self, request: Request, error: Optional[BaseException] = None):
+        throttled = error is not None and is_rate_limited(error)
+        self.concurrency.release(request.started, throttled)
+        if not throttled:
+            return
+        self.count("throttled")
+        delay = retry_after(error)
+        if delay:
+            with self._lock:
+                self._paused_until = max(
+                    self._paused_until, time.monotonic() + delay
+                )
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["concurrency_limit"] = int(self.concurrency.limit)
+        return stats
+
+
+_LIMITS: Dict[str, Limits] = {}
+_LIMITERS: Dict[str, ProviderLimiter] = {}
+_LIMITERS_LOCK = threading.Lock()
+_JITTER = random.Random()
+
+
+def configure(provider: str, limits: Limits):
+    """Sets the limits of a provider, resetting its limiter."""
+    with _LIMITERS_LOCK:
+        _LIMITS[provider] = limits
+        _LIMITERS.pop(provider, None)
+
+
+def get_limiter(provider: str) -> ProviderLimiter:
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(provider)
+        if limiter is None:
+            limiter = ProviderLimiter(provider, _LIMITS.get(provider, Limits()))
+            _LIMITERS[provider] = limiter
+        return limiter
+
+
+def reset():
+    """Drops all limits, limiters and their stats."""
+    with _LIMITERS_LOCK:
+        _LIMITS.clear()
+        _LIMITERS.clear()
+
+
+def stats() -> Dict[str, Dict[str, float]]:
+    """Returns the stats of every provider used so far."""
+    with _LIMITERS_LOCK:
+        limiters = list(_LIMITERS.values())
+    return {limiter.provider: limiter.stats() for limiter in limiters}
+
+
+@contextlib.contextmanager
+def limit(provider: str, tokens: int):
+    """Waits for the provider's limits to admit a request, and reports how
+    the request went when the block exits."""
+    limiter = get_limiter(provider)
+    request = limiter.acquire(tokens)
+    try:
+        yield request
+    except BaseException as e:
+        limiter.release(request, e)
+        raise
+    limiter.release(request)
+
+
+@contextlib.asynccontextmanager
+async def alimit(provider: str, tokens: int):
+    """Async version of `limit`."""
+    limiter = get_limiter(provider)
+    request = await limiter.aacquire(tokens)
+    try:
+        yield request
+    except BaseException as e:
+        limiter.release(request, e)
+        raise
+    limiter.release(request)
+
+
+def backoff(provider: str, retry: int, error: Any = None) -> float:
+    """Returns how long to wait before retry number `retry` (from 1).
+
+    The delay is exponential with full jitter, and at least the error's
+    `Retry-After`. It is counted in the provider's `backoff_s`.
+    """
+    delay = _JITTER.uniform(
+        0, min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** (retry - 1))
+    )
+    requested = retry_after(error) if error is not None else None
+    if requested:
+        delay = max(delay, requested)
+    get_limiter(provider).count("backoff_s", delay)
+    return delay
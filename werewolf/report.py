@@ -0,0 +1,237 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reports on the games of all evals: win rates, ratings and role metrics.
+
+The report is computed from the eval CSVs and the tables of
+`werewolf.analytics`, so it never re-runs a game, and only the games played
+since the last report are read again:
+
+  - Win rates of every pairing of villager and werewolf models, with Wilson
+    confidence intervals.
+  - Elo ratings of the models from a Bradley-Terry model of all games, with a
+    term for the advantage of playing the villagers.
+  - Role metrics per villager model: how often the seer survives the game and
+    how often the doctor protects the player the werewolves attack.
+
+pandas and numpy are imported when a report is computed, as they are slow to
+import.
+"""
+
+import glob
+import math
+import os
+import statistics
+from typing import Any, Dict, List
+
+from werewolf import analytics
+from werewolf.model import SEER
+
+VILLAGERS_WIN = "Villagers"
+WEREWOLVES_WIN = "Werewolves"
+# Converts Bradley-Terry log-odds to Elo points, and the Elo of a model of
+# average strength.
+ELO_SCALE = 400 / math.log(10)
+ELO_BASE = 1500
+# Gaussian prior on the log-odds strengths and advantage, which keeps them
+# finite when a model or a side won or lost all its games.
+RATING_PRIOR = 0.1
+
+
+def load_results(paths: List[str]):
+    """Reads eval CSVs into one DataFrame of the games that finished.
+
+    A game listed in several CSVs is counted once.
+    """
+    import pandas as pd
+
+    frames = [pd.read_csv(path, index_col=0) for path in paths]
+    if not frames:
+        return pd.DataFrame(
+            columns=["VillagerModel", "WerewolfModel", "Winner", "Log"]
+        )
+    results = pd.concat(frames, ignore_index=True)
+    results = results[results["Winner"].isin([VILLAGERS_WIN, WEREWOLVES_WIN])]
+    return results.drop_duplicates("Log", keep="last").reset_index(drop=True)
+
+
+def win_rates(results, confidence: float = 0.95):
+    """Returns the villagers' win rate of every pairing of models.
+
+    The confidence interval is the Wilson score interval, which unlike a
+    bootstrap doesn't collapse to a point when the villagers won none or all of
+    a pairing's games.
+    """
+    import numpy as np
+
+    pairings = (
+        results.assign(won=results["Winner"] == VILLAGERS_WIN)
+        .groupby(["VillagerModel", "WerewolfModel"])["won"]
+        .agg(games="size", villager_wins="sum")
+        .reset_index()
+    )
+    games = pairings["games"].to_numpy()
+    wins = pairings["villager_wins"].to_numpy()
+    rate = wins / games
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    center = (wins + z**2 / 2) / (games + z**2)
+    spread = (
+        z / (games + z**2) * np.sqrt(wins * (games - wins) / games + z**2 / 4)
+    )
+    return pairings.assign(
+        villager_win_rate=rate, ci_low=center - spread, ci_high=center + spread
+    )
+
+
+def ratings(results) -> tuple[Any, float]:
+    """Fits a Bradley-Terry model of all games and returns Elo ratings.
+
+    The villagers win with probability sigmoid(s_v - s_w + h), where s_v and
+    s_w are the strengths of the villager and werewolf models and h is the
+    advantage of playing the villagers. Games are aggregated by pairing, and
+    the model is fit with Newton's method.
+
+    Returns:
+      A DataFrame of every model's games, wins, Elo and its standard error,
+      and the villagers' advantage in Elo points.
+    """
+    import numpy as np
+    import pandas as pd
+
+    pairings = (
+        results.assign(won=results["Winner"] == VILLAGERS_WIN)
+        .groupby(["VillagerModel", "WerewolfModel"])["won"]
+        .agg(["size", "sum"])
+        .reset_index()
+    )
+    models = sorted(
+        set(pairings["VillagerModel"]) | set(pairings["WerewolfModel"])
+    )
+    index = {model: i for i, model in enumerate(models)}
+    rows = np.arange(len(pairings))
+    villagers = pairings["VillagerModel"].map(index).to_numpy()
+    werewolves = pairings["WerewolfModel"].map(index).to_numpy()
+    # One column per model, and the last one for the villagers' advantage.
+    design = np.zeros((len(pairings), len(models) + 1))
+    np.add.at(design, (rows, villagers), 1)
+    np.add.at(design, (rows, werewolves), -1)
+    design[:, -1] = 1
+    games = pairings["size"].to_numpy(dtype=float)
+    wins = pairings["sum"].to_numpy(dtype=float)
+    prior = np.full(len(models) + 1, RATING_PRIOR)
+
+    params = np.zeros(len(models) + 1)
+    for _ in range(100):
+        p = 1 / (1 + np.exp(-design @ params))
+        gradient = design.T @ (wins - games * p) - prior * params
+        hessian = (design.T * (games * p * (1 - p))) @ design + np.diag(prior)
+        step = np.linalg.solve(hessian, gradient)
+        params += step
+        if np.abs(step).max() < 1e-10:
+            break
+    # Only differences of strengths are identified, so the errors are those of
+    # the strengths relative to their mean.
+    covariance = np.linalg.inv(hessian)[:-1, :-1]
+    centering = np.eye(len(models)) - 1 / len(models)
+    errors = np.sqrt(np.diag(centering @ covariance @ centering))
+
+    def side_totals(side: str, won: np.ndarray):
+        return pairings.assign(won=won).groupby(side)[["size", "won"]].sum()
+
+    as_villagers = side_totals("VillagerModel", wins)
+    as_werewolves = side_totals("WerewolfModel", games - wins)
+    totals = as_villagers.add(as_werewolves, fill_value=0).reindex(models)
+    table = pd.DataFrame(
+        {
+            "model": models,
+            "games": totals["size"].to_numpy(dtype=int),
+            "wins": totals["won"].to_numpy(dtype=int),
+            "elo": ELO_BASE + ELO_SCALE * params[:-1],
+            "elo_stderr": ELO_SCALE * errors,
+        }
+    ).sort_values("elo", ascending=False, ignore_index=True)
+    return table, ELO_SCALE * params[-1]
+
+
+def role_metrics(analytics_dir: str):
+    """Returns the seer's survival rate and the doctor's save rate per
+    villager model, from the tables of `werewolf.analytics`."""
+    games = analytics.load_table(analytics_dir, "games")
+    if games.empty:
+        return games
+    players = analytics.load_table(analytics_dir, "players")
+    rounds = analytics.load_table(analytics_dir, "rounds")
+    models = games.set_index("session_id")["villager_model"]
+
+    seers = players[players["role"] == SEER]
+    seer_survival = (
+        seers.assign(
+            villager_model=seers["session_id"].map(models),
+            survived=seers["removed_round"].isna(),
+        )
+        .groupby("villager_model")["survived"]
+        .mean()
+    )
+    # Rounds where the doctor didn't protect anyone, e.g. after the doctor was
+    # removed, are not attacks they could have saved.
+    attacks = rounds[rounds["eliminated"].notna() & rounds["protected"].notna()]
+    save_rate = (
+        attacks.assign(
+            villager_model=attacks["session_id"].map(models),
+            saved=attacks["protected"] == attacks["eliminated"],
+        )
+        .groupby("villager_model")["saved"]
+        .agg(attacks="size", doctor_save_rate="mean")
+    )
+    return (
+        games.groupby("villager_model")
+        .size()
+        .rename("games")
+        .to_frame()
+        .join(seer_survival.rename("seer_survival"))
+        .join(save_rate)
+        .reset_index()
+    )
+
+
+def build(logs_dir: str, analytics_dir: str) -> Dict[str, Any]:
+    """Computes the report on every eval CSV in `logs_dir`.
+
+    The games not yet in `analytics_dir` are exported to it first.
+    """
+    analytics.export(logs_dir, analytics_dir)
+    results = load_results(
+        sorted(glob.glob(os.path.join(logs_dir, "eval_results_*.csv")))
+    )
+    report = {"games": len(results), "roles": role_metrics(analytics_dir)}
+    if len(results):
+        report["win_rates"] = win_rates(results)
+        report["ratings"], report["villager_advantage"] = ratings(results)
+    return report
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"######## Report on {report['games']} games ########")
+    if "win_rates" in report:
+        print("######## Villager win rate per pairing (95% CI) ########")
+        print(report["win_rates"].to_string(index=False))
+        print("######## Elo ratings ########")
+        print(report["ratings"].to_string(index=False))
+        print(
+            "Villagers' advantage:"
+            f" {report['villager_advantage']:+.0f} Elo points"
+        )
+    if not report["roles"].empty:
+        print("######## Roles per villager model ########")
+        print(report["roles"].to_string(index=False))
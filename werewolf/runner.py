@@ -12,26 +12,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor, as_completed
+import csv
 import random
 import traceback
-from typing import List, Tuple
+from typing import Callable, List, Optional, Tuple
 import itertools
-import pandas as pd
 import os
-import datetime
+import time
 
 from absl import flags
 import tqdm
 
+from werewolf import analytics
+from werewolf import cache
 from werewolf import logging
 from werewolf import game
+from werewolf import lm
+from werewolf import ratelimit
+from werewolf import report
 from werewolf.model import Doctor
+from werewolf.model import RoundLog
 from werewolf.model import SEER
 from werewolf.model import Seer
 from werewolf.model import State
 from werewolf.model import Villager
 from werewolf.model import WEREWOLF
 from werewolf.model import Werewolf
+from werewolf.model import to_dict
+from werewolf.model import usage_by_phase
+from werewolf.lm import USAGE_FIELDS, UsageTotals
 from werewolf.config import get_player_names
 
 _RUN_GAME = flags.DEFINE_boolean("run", False, "Runs a single game.")
@@ -41,15 +52,115 @@ _NUM_GAMES = flags.DEFINE_integer(
     "num_games", 2, "Number of games to run used with eval."
 )
 _VILLAGER_MODELS = flags.DEFINE_list(
-    "v_models", "", "The model used for villagers values are: flash, pro, gpt4"
+    "v_models",
+    "",
+    "The model used for villagers values are: flash, pro, gpt4, mock, or a"
+    " mock with options such as mock:latency=200ms",
 )
 _WEREWOLF_MODELS = flags.DEFINE_list(
-    "w_models", "", "The model used for werewolves values are: flash, pro, gpt4"
+    "w_models",
+    "",
+    "The model used for werewolves values are: flash, pro, gpt4, mock, or a"
+    " mock with options such as mock:latency=200ms",
 )
 _ARENA = flags.DEFINE_boolean(
     "arena", False, "Only run games using different models for villagers and werewolves"
 )
-_THREADS = flags.DEFINE_integer("threads", 2, "Number of threads to run.")
+_THREADS = flags.DEFINE_integer(
+    "threads",
+    2,
+    "Number of threads to run. The threads are shared by all games.",
+)
+_PARALLEL_GAMES = flags.DEFINE_integer(
+    "parallel_games",
+    1,
+    "Number of games to run concurrently with eval. The games share the"
+    " threads and the request limit.",
+)
+_ASYNC_ENGINE = flags.DEFINE_boolean(
+    "async_engine",
+    False,
+    "Runs games on a single asyncio event loop instead of threads.",
+)
+_MAX_CONCURRENT_REQUESTS = flags.DEFINE_integer(
+    "max_concurrent_requests",
+    0,
+    "Maximum number of LLM requests in flight across all games. 0 means no"
+    " limit.",
+)
+
+_SPECULATIVE_DEBATE = flags.DEFINE_integer(
+    "speculative_debate",
+    0,
+    "Number of debate turns per turn generated for the likely speakers while"
+    " the bids are still coming in. Turns of players who lose the bid are"
+    " discarded. 0 disables speculation.",
+)
+_RATE_LIMITS = flags.DEFINE_list(
+    "rate_limits",
+    [],
+    "Client-side limits per provider (openai, anthropic, vertexai or mock),"
+    " e.g. openai:rpm=500:tpm=300000:concurrency=32. Requests in flight also"
+    " adapt to the provider's throttling.",
+)
+_RESPONSE_CACHE = flags.DEFINE_string(
+    "response_cache",
+    "",
+    "Path of an SQLite cache of model responses. Requests already in it are"
+    " not sent again.",
+)
+_RESPONSE_CACHE_MB = flags.DEFINE_integer(
+    "response_cache_mb",
+    cache.DEFAULT_MAX_BYTES >> 20,
+    "Size in MB above which the least recently used responses are evicted.",
+)
+_REPLAY = flags.DEFINE_list(
+    "replay",
+    [],
+    "Game directories to re-run purely from --response_cache. A request that"
+    " isn't cached fails the game.",
+)
+_LOG_FORMAT = flags.DEFINE_enum(
+    "log_format",
+    "json",
+    logging.LOG_FORMATS,
+    "Format of the game logs: json, which the viewer reads, or compact, a"
+    " gzipped file several times smaller.",
+)
+_PROMPT_FORMAT = flags.DEFINE_enum(
+    "prompt_format",
+    "text",
+    logging.PROMPT_FORMATS,
+    "How prompts are logged: text, or template, i.e. the template and the"
+    " worldstate they are rendered from when the logs are loaded. template"
+    " requires --log_format=compact.",
+)
+flags.register_multi_flags_validator(
+    ["log_format", "prompt_format"],
+    lambda values: values["prompt_format"] != "template"
+    or values["log_format"] == "compact",
+    message="--prompt_format=template requires --log_format=compact, as the"
+    " viewer reads the prompts of game_logs.json.",
+)
+_RENDER_PROMPTS = flags.DEFINE_list(
+    "render_prompts",
+    [],
+    "Game directories with compact logs whose prompts are rendered to a"
+    " separate game_logs.json, for the viewer.",
+)
+_EXPORT_ANALYTICS = flags.DEFINE_string(
+    "export_analytics",
+    "",
+    "Directory to which the completed games in logs/ that it doesn't have yet"
+    " are exported as tables, see werewolf/analytics.py.",
+)
+_REPORT = flags.DEFINE_boolean(
+    "report",
+    False,
+    "Reports the win rates, Elo ratings and role metrics of all the evals in"
+    " logs/, from their results and the exported tables. Games are exported"
+    " to --export_analytics, or logs/analytics, first.",
+)
 
 DEFAULT_WEREWOLF_MODELS = ["flash", "pro1.5"]
 DEFAULT_VILLAGER_MODELS = ["flash", "pro1.5"]
@@ -62,16 +173,23 @@ model_to_id = {
     "gpt4": "gpt-4-turbo-2024-04-09",
     "gpt4o": "gpt-4o-2024-05-13",
     "gpt3.5": "gpt-3.5-turbo-0125",
+    # Offline model for benchmarking, see werewolf/mock.py for the options.
+    "mock": "mock",
 }
 
 
 def initialize_players(
-    villager_model: str, werewolf_model: str
+    villager_model: str, werewolf_model: str, seed: Optional[int] = None
 ) -> Tuple[Seer, Doctor, List[Villager], List[Werewolf]]:
-    """Assigns roles to players and initializes their game view."""
+    """Assigns roles to players and initializes their game view.
+
+    The same seed always gives the same names and roles. Without a seed, they
+    are drawn from `random`.
+    """
 
-    player_names = get_player_names()
-    random.shuffle(player_names)
+    rng = random if seed is None else random.Random(seed)
+    player_names = get_player_names(rng)
+    rng.shuffle(player_names)
 
     seer = Seer(
         name=player_names.pop(),
@@ -103,7 +221,7 @@ def initialize_players(
     return seer, doctor, villagers, werewolves
 
 
-def resume_game(directory: str) -> bool:
+def resume_game(directory: str, executor: Optional[Executor] = None) -> bool:
     state, logs = logging.load_game(directory)
 
     # remove the failed round and resume from the beginning of that round.
@@ -168,24 +286,31 @@ def resume_game(directory: str) -> bool:
             werewolves[0].gamestate.other_wolf = werewolves[1].name
             werewolves[1].gamestate.other_wolf = werewolves[0].name
 
-    gm = game.GameMaster(state, num_threads=_THREADS.value)
+    gm = game.GameMaster(
+        state,
+        num_threads=_THREADS.value,
+        executor=executor,
+        checkpoint=logging.CheckpointWriter(directory),
+    )
     gm.logs = logs
     try:
         gm.run_game()
     except Exception as e:
         state.error_message = traceback.format_exc()
-    logging.save_game(state, gm.logs, directory)
+    logging.save_game(
+        state, gm.logs, directory, _LOG_FORMAT.value, _PROMPT_FORMAT.value
+    )
     return not state.error_message
 
 
-def resume_games(directories: list[str]):
+def resume_games(directories: list[str], executor: Optional[Executor] = None):
     successful_resumes = []
     failed_resumes = []
     invalid_resumes = []
     for i in tqdm.tqdm(range(len(directories)), desc="Games"):
         d = directories[i]
         try:
-            success = resume_game(d)
+            success = resume_game(d, executor=executor)
             if success:
                 successful_resumes.append(d)
             else:
@@ -202,27 +327,149 @@ def resume_games(directories: list[str]):
     )
 
 
-def run_game(
-    werewolf_model: str,
-    villager_model: str,
-) -> Tuple[str, str]:
-    """Runs a single game of Werewolf.
-
-    Returns: (winner, log_dir)
-    """
+def _new_game(
+    werewolf_model: str, villager_model: str, seed: Optional[int] = None
+) -> State:
+    if seed is None:
+        seed = random.getrandbits(32)
     seer, doctor, villagers, werewolves = initialize_players(
-        villager_model, werewolf_model
+        villager_model, werewolf_model, seed=seed
     )
-    session_id = "10"  # You might want to make this unique per game
-    state = State(
+    return State(
         villagers=villagers,
         werewolves=werewolves,
         seer=seer,
         doctor=doctor,
-        session_id=session_id,
+        session_id=logging.new_session_id(),
+        seed=seed,
+    )
+
+
+def replay_game(directory: str, executor: Optional[Executor] = None) -> bool:
+    """Re-runs a recorded game with its seed, using only cached responses.
+
+    The replay is saved to a new log directory. Returns whether its logs and
+    winner are identical to the original ones.
+    """
+    original, original_logs = logging.load_game(directory)
+    if original.seed is None:
+        raise ValueError(f"{directory} was recorded without a seed.")
+
+    state = _new_game(
+        werewolf_model=original.werewolves[0].model,
+        villager_model=original.seer.model,
+        seed=original.seed,
+    )
+    log_directory = logging.log_directory(state.session_id)
+    gamemaster = game.GameMaster(
+        state, num_threads=_THREADS.value, executor=executor
     )
+    try:
+        gamemaster.run_game()
+    except Exception as e:
+        state.error_message = traceback.format_exc()
+        print(f"Error encountered during replay: {e}")
+    _save_game(state, gamemaster.logs, log_directory)
+
+    return state.winner == original.winner and _without_usage(
+        to_dict(gamemaster.logs)
+    ) == _without_usage(to_dict(original_logs))
+
+
+def _without_usage(data):
+    """Drops the latency and token counts, which differ between runs."""
+    if isinstance(data, dict):
+        return {
+            k: _without_usage(v)
+            for k, v in data.items()
+            if k not in USAGE_FIELDS
+        }
+    if isinstance(data, list):
+        return [_without_usage(v) for v in data]
+    return data
+
+
+def replay_games(directories: list[str], executor: Optional[Executor] = None):
+    identical_replays = []
+    different_replays = []
+    for d in tqdm.tqdm(directories, desc="Games"):
+        if replay_game(d, executor=executor):
+            identical_replays.append(d)
+        else:
+            different_replays.append(d)
+
+    print(
+        f"Identical replays: {identical_replays}.\nDifferent or failed"
+        f" replays: {different_replays}\nResponse cache:"
+        f" {lm.get_response_cache().stats()}"
+    )
+
+
+USAGE_COLUMNS = [
+    "Seconds",
+    "Calls",
+    "InputTokens",
+    "CachedInputTokens",
+    "OutputTokens",
+]
+
+
+def _game_usage(
+    state: State, logs: List[RoundLog], seconds: float
+) -> List[float]:
+    """Returns the values of `USAGE_COLUMNS` for a game."""
+    totals = UsageTotals()
+    for phase_totals in usage_by_phase(logs).values():
+        totals.merge(phase_totals)
+    return [
+        round(seconds, 3),
+        totals.calls,
+        totals.input_tokens,
+        totals.cached_input_tokens,
+        totals.output_tokens,
+    ]
+
+
+def _report_speculation(gamemaster: game.GameMaster):
+    if gamemaster.speculation_budget:
+        print(f"Speculative debates: {dict(gamemaster.speculation)}")
+
+
+def _save_game(state: State, logs: List[RoundLog], log_directory: str):
+    logging.save_game(
+        state, logs, log_directory, _LOG_FORMAT.value, _PROMPT_FORMAT.value
+    )
+    print(f"Game logs saved to: {log_directory}")
 
-    gamemaster = game.GameMaster(state, num_threads=_THREADS.value)
+
+def run_game(
+    werewolf_model: str,
+    villager_model: str,
+    executor: Optional[Executor] = None,
+    manifest: Optional[logging.EvalManifest] = None,
+) -> Tuple[str, str, List[float]]:
+    """Runs a single game of Werewolf.
+
+    Args:
+      werewolf_model: The model of the werewolves.
+      villager_model: The model of the other players.
+      executor: Shared executor for the player actions.
+      manifest: Where to record the start and the end of the game.
+
+    Returns: (winner, log_dir, usage) where usage holds the `USAGE_COLUMNS`.
+    """
+    start = time.perf_counter()
+    state = _new_game(werewolf_model, villager_model)
+    log_directory = logging.log_directory(state.session_id)
+    if manifest:
+        manifest.start(state, log_directory)
+    gamemaster = game.GameMaster(
+        state,
+        num_threads=_THREADS.value,
+        executor=executor,
+        checkpoint=logging.CheckpointWriter(log_directory),
+        speculation_budget=_SPECULATIVE_DEBATE.value,
+    )
     winner = None
     try:
         winner = gamemaster.run_game()
@@ -230,54 +477,218 @@ def run_game(
         state.error_message = traceback.format_exc()
         print(f"Error encountered during game: {e}")
 
-    log_directory = logging.log_directory()
-    logging.save_game(state, gamemaster.logs, log_directory)
-    print(f"Game logs saved to: {log_directory}")
+    _save_game(state, gamemaster.logs, log_directory)
+    if manifest:
+        manifest.finish(state, log_directory)
+    _report_speculation(gamemaster)
+    usage = _game_usage(state, gamemaster.logs, time.perf_counter() - start)
+    return winner, log_directory, usage
+
+
+async def arun_game(
+    werewolf_model: str,
+    villager_model: str,
+    manifest: Optional[logging.EvalManifest] = None,
+) -> Tuple[str, str, List[float]]:
+    """Runs a single game of Werewolf on the asyncio event loop.
+
+    Returns: (winner, log_dir, usage) where usage holds the `USAGE_COLUMNS`.
+    """
+    start = time.perf_counter()
+    state = _new_game(werewolf_model, villager_model)
+    log_directory = logging.log_directory(state.session_id)
+    if manifest:
+        manifest.start(state, log_directory)
+    gamemaster = game.AsyncGameMaster(
+        state,
+        checkpoint=logging.CheckpointWriter(log_directory),
+        speculation_budget=_SPECULATIVE_DEBATE.value,
+    )
+    winner = None
+    try:
+        winner = await gamemaster.run_game()
+    except Exception as e:
+        state.error_message = traceback.format_exc()
+        print(f"Error encountered during game: {e}")
+
+    await asyncio.to_thread(_save_game, state, gamemaster.logs, log_directory)
+    if manifest:
+        manifest.finish(state, log_directory)
+    _report_speculation(gamemaster)
+    usage = _game_usage(state, gamemaster.logs, time.perf_counter() - start)
+    return winner, log_directory, usage
+
+
+def _run_games(
+    jobs: List[Tuple[str, str]],
+    executor: Executor,
+    manifest: logging.EvalManifest,
+    on_result: Callable[[str, str, str, str, List[float]], None],
+) -> None:
+    """Runs the games on `--parallel_games` threads."""
+    with ThreadPoolExecutor(max_workers=_PARALLEL_GAMES.value) as game_executor:
+        games = {
+            game_executor.submit(
+                run_game,
+                werewolf_model=werewolf_model,
+                villager_model=villager_model,
+                executor=executor,
+                manifest=manifest,
+            ): (villager_model, werewolf_model)
+            for villager_model, werewolf_model in jobs
+        }
+        for task in as_completed(games):
+            villager_model, werewolf_model = games[task]
+            on_result(villager_model, werewolf_model, *task.result())
+
+
+async def _arun_games(
+    jobs: List[Tuple[str, str]],
+    manifest: logging.EvalManifest,
+    on_result: Callable[[str, str, str, str, List[float]], None],
+) -> None:
+    """Runs up to `--parallel_games` games at a time on the event loop."""
+    slots = asyncio.Semaphore(_PARALLEL_GAMES.value)
+
+    async def run_one(villager_model, werewolf_model):
+        async with slots:
+            winner, log_dir, usage = await arun_game(
+                werewolf_model=werewolf_model,
+                villager_model=villager_model,
+                manifest=manifest,
+            )
+        return villager_model, werewolf_model, winner, log_dir, usage
 
-    return winner, log_directory
+    for task in asyncio.as_completed([run_one(*job) for job in jobs]):
+        on_result(*await task)
+
+
+def run_eval(
+    model_combinations: List[Tuple[str, str]], executor: Executor
+) -> None:
+    """Runs `--num_games` games for every model combination.
+
+    Up to `--parallel_games` games run at the same time. Results are appended
+    to the eval CSV as soon as each game finishes.
+    """
+    jobs = []
+    for villager_model, werewolf_model in model_combinations:
+        # only run games using different models in the arena mode
+        if villager_model == werewolf_model and _ARENA.value:
+            continue
+        print(
+            f"Running games with Villagers: {villager_model} and"
+            f" Werewolves:{werewolf_model}"
+        )
+        jobs.extend([(villager_model, werewolf_model)] * _NUM_GAMES.value)
+
+    # Evals started at the same time, e.g. by several processes, get different
+    # ids and files.
+    eval_id = logging.new_session_id()
+    os.makedirs(f"{os.getcwd()}/logs", exist_ok=True)
+    csv_file = f"{os.getcwd()}/logs/eval_results_{eval_id}.csv"
+    manifest = logging.EvalManifest(
+        f"{os.getcwd()}/logs/eval_manifest_{eval_id}.jsonl"
+    )
+    columns = ["VillagerModel", "WerewolfModel", "Winner", "Log"]
+    columns += USAGE_COLUMNS
+
+    results = []
+    with open(csv_file, "x", newline="") as file, tqdm.tqdm(
+        total=len(jobs), desc="Games"
+    ) as progress:
+        writer = csv.writer(file)
+        writer.writerow([""] + columns)
+        file.flush()
+
+        def on_result(villager_model, werewolf_model, winner, log_dir, usage):
+            row = [villager_model, werewolf_model, winner, log_dir] + usage
+            writer.writerow([len(results)] + row)
+            file.flush()
+            results.append(row)
+            progress.update()
+
+        if _ASYNC_ENGINE.value:
+            asyncio.run(_arun_games(jobs, manifest, on_result))
+        else:
+            _run_games(jobs, executor, manifest, on_result)
+
+    # pandas is slow to import and only needed for this report.
+    import pandas as pd
+
+    df = pd.DataFrame(results, columns=columns)
+    print("######## Eval results ########")
+    print(df)
+    print("######## Mean usage per game ########")
+    print(df.groupby(["VillagerModel", "WerewolfModel"])[USAGE_COLUMNS].mean())
+    print(f"Rate limiting: {ratelimit.stats()}")
+    print(f"Wrote eval results to {csv_file} and the games to {manifest.path}")
 
 
 def run() -> None:
+    lm.set_max_concurrent_requests(_MAX_CONCURRENT_REQUESTS.value)
+    for spec in _RATE_LIMITS.value:
+        ratelimit.configure(*ratelimit.parse_limits(spec))
+    if _RESPONSE_CACHE.value:
+        lm.set_response_cache(
+            cache.ResponseCache(
+                _RESPONSE_CACHE.value,
+                max_bytes=_RESPONSE_CACHE_MB.value << 20,
+            ),
+            replay=bool(_REPLAY.value),
+        )
+    elif _REPLAY.value:
+        raise ValueError("--replay needs a --response_cache to replay from.")
+    with ThreadPoolExecutor(max_workers=_THREADS.value) as executor:
+        _run(executor)
+
+
+def _run(executor: Executor) -> None:
     villager_models = _VILLAGER_MODELS.value or DEFAULT_VILLAGER_MODELS
     werewolf_models = _WEREWOLF_MODELS.value or DEFAULT_WEREWOLF_MODELS
-    v_ids = [model_to_id[m] for m in villager_models]
-    w_ids = [model_to_id[m] for m in werewolf_models]
+    v_ids = [model_to_id.get(m, m) for m in villager_models]
+    w_ids = [model_to_id.get(m, m) for m in werewolf_models]
     model_combinations = list(itertools.product(v_ids, w_ids))
     if _RUN_GAME.value:
         villager_model, werewolf_model = model_combinations[0]
         print(f"Villagers: {villager_model} versus Werwolves:  {werewolf_model}")
-        run_game(
-            werewolf_model=werewolf_model,
-            villager_model=villager_model,
-        )
-    elif _EVAL.value:
-        results = []
-        for villager_model, werewolf_model in model_combinations:
-            # only run games using different models in the arena mode
-            if villager_model == werewolf_model and _ARENA.value:
-                continue
-            print(
-                f"Running games with Villagers: {villager_model} and"
-                f" Werewolves:{werewolf_model}"
-            )
-            for _ in tqdm.tqdm(range(_NUM_GAMES.value), desc="Games"):
-                winner, log_dir = run_game(
+        if _ASYNC_ENGINE.value:
+            asyncio.run(
+                arun_game(
                     werewolf_model=werewolf_model,
                     villager_model=villager_model,
                 )
-                results.append([villager_model, werewolf_model, winner, log_dir])
+            )
+        else:
+            run_game(
+                werewolf_model=werewolf_model,
+                villager_model=villager_model,
+                executor=executor,
+            )
+    elif _EVAL.value:
+        run_eval(model_combinations, executor)
 
-        df = pd.DataFrame(
-            results, columns=["VillagerModel", "WerewolfModel", "Winner", "Log"]
-        )
-        print("######## Eval results ########")
-        print(df)
+    elif _RESUME.value:
+        resume_games(RESUME_DIRECTORIES, executor=executor)
 
-        pacific_timezone = datetime.timezone(datetime.timedelta(hours=-8))
-        timestamp = datetime.datetime.now(pacific_timezone).strftime("%Y%m%d_%H%M%S")
-        csv_file = f"{os.getcwd()}/logs/eval_results_{timestamp}.csv"
-        df.to_csv(csv_file)
-        print(f"Wrote eval results to {csv_file}")
+    elif _REPLAY.value:
+        replay_games(_REPLAY.value, executor=executor)
 
-    elif _RESUME.value:
-        resume_games(RESUME_DIRECTORIES)
+    elif _RENDER_PROMPTS.value:
+        for directory in _RENDER_PROMPTS.value:
+            logging.render_prompts(directory)
+            print(f"Game logs saved to: {directory}")
+
+    elif _REPORT.value:
+        logs_dir = f"{os.getcwd()}/logs"
+        report.print_report(
+            report.build(
+                logs_dir, _EXPORT_ANALYTICS.value or f"{logs_dir}/analytics"
+            )
+        )
+
+    elif _EXPORT_ANALYTICS.value:
+        exported = analytics.export(
+            f"{os.getcwd()}/logs", _EXPORT_ANALYTICS.value
+        )
+        print(f"Exported {exported} games to {_EXPORT_ANALYTICS.value}")
@@ -14,21 +14,109 @@
 
 """utility functions."""
 
+import collections
+import json
+import re
+import threading
 from typing import Any
 import yaml
 from abc import ABC
 from abc import abstractmethod
 import marko
 
+_JSON_FENCE = re.compile(
+    r"```[ \t]*json[ \t]*\n(.*?)```", re.DOTALL | re.IGNORECASE
+)
+
+_PARSE_STATS: collections.Counter = collections.Counter()
+_PARSE_STATS_LOCK = threading.Lock()
+
+
+def _count(tier: str):
+    with _PARSE_STATS_LOCK:
+        _PARSE_STATS[tier] += 1
+
+
+def parse_json_stats() -> dict[str, int]:
+    """Returns how many responses were parsed by each tier of `parse_json`."""
+    with _PARSE_STATS_LOCK:
+        return dict(_PARSE_STATS)
+
 
 def parse_json(text: str) -> dict[str, Any] | None:
+    """Parses the JSON object in a model response.
+
+    The cheap parsers run first: the whole text as strict JSON, then the first
+    ```json block or the first {...} object as strict JSON. Responses that are
+    not strict JSON (e.g. unquoted keys) fall back to the markdown and YAML
+    parsers.
+    """
+    result_json = _load_json_object(text)
+    if result_json is not None:
+        _count("json")
+        return result_json
+
+    fence = _JSON_FENCE.search(text)
+    if fence:
+        result_json = _load_json_object(fence.group(1))
+        if result_json is not None:
+            _count("fenced")
+            return result_json
+
+    embedded = extract_json_object(text)
+    if embedded:
+        result_json = _load_json_object(embedded)
+        if result_json is not None:
+            _count("embedded")
+            return result_json
+
     result_json = parse_json_markdown(text)
+    if result_json:
+        _count("markdown")
+        return result_json
 
-    if not result_json:
-        result_json = parse_json_str(text)
+    result_json = parse_json_str(text)
+    _count("yaml" if result_json else "failed")
     return result_json
 
 
+def _load_json_object(text: str) -> dict[str, Any] | None:
+    try:
+        result_json = json.loads(text)
+    except ValueError:
+        return None
+    return result_json if isinstance(result_json, dict) else None
+
+
+def extract_json_object(text: str) -> str | None:
+    """Returns the first balanced {...} in the text, ignoring braces in strings."""
+    start = text.find("{")
+    if start < 0:
+        return None
+
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start : i + 1]
+    return None
+
+
 def parse_json_markdown(text: str) -> dict[str, Any] | None:
     ast = marko.parse(text)
 